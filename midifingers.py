@@ -381,6 +381,26 @@ class ControlPanel(QtGui.QGroupBox):
 	def set_maxpitch(self,v):
 	 	self.spinbox_maxpitch.setValue(v)
 
+class QtExecutor(QtCore.QObject):
+	"""
+	An executor for Midi input callbacks (see the MidiThread's
+	input_delivery) that runs them on the Qt GUI thread, by emitting
+	a queued signal.  Create it on the GUI thread.
+	"""
+
+	called = QtCore.Signal(object)
+
+	def __init__(self):
+		super(QtExecutor, self).__init__()
+		self.called.connect(self.run_call,QtCore.Qt.QueuedConnection)
+
+	def submit(self,func,*args):
+		self.called.emit((func,args))
+
+	def run_call(self,call):
+		(func,args) = call
+		func(*args)
+
 class MidiFingers(QtGui.QWidget):
 
 	def __init__(self):
@@ -427,14 +447,19 @@ class MidiFingers(QtGui.QWidget):
 
 		self.sids = {}
 
-		Midi.startup()
+		# Input callbacks update the GUI, so they're run on the GUI
+		# thread, rather than on the MIDI thread (or any other)
+		self.qtexecutor = QtExecutor()
+		Midi.startup(input_delivery=self.qtexecutor)
 		self.midi = MidiPypmHardware()
 		midiinputs = self.midi.input_devices()
 		midioutputs = self.midi.output_devices()
 		self.midiin = None
 		self.midiout = None
 
-		Midi.callback(self.midicallback,"")
+		Midi.subscribe(self.midinoteon,types=[NoteOn])
+		Midi.subscribe(self.midinoteoff,types=[NoteOff])
+		Midi.subscribe(self.midicontroller,types=[Controller])
 
 		x, y, w, h = 500, 200, 100, 100
 		self.setGeometry(x, y, w, h)
@@ -567,6 +592,10 @@ class MidiFingers(QtGui.QWidget):
 			# if name is "None", we leave self.midiin as None
 			if name != "None":
 				self.midiin = self.midi.get_input(name)
+				# Only notes and controllers are subscribed to
+				self.midiin.set_filter(MidiInputFilter(realtime=True,
+					sysex=True,types=(Pressure,Program,
+					ChannelPressure,PitchBend)))
 				self.midiin.open()
 			# self.set_message("MIDI input set to: %s" % name)
 			self.set_message("")
@@ -630,27 +659,29 @@ class MidiFingers(QtGui.QWidget):
 	def closeEvent(self, evt):
 		self.panel.close_help()
 
-	def midicallback(self,msg,data):
+	def midinoteon(self,msg,data):
 		if self.debug > 0:
 			print("MIDI INPUT = %s" % str(msg))
 		m = msg.midimsg
+		self.midinotesdown += 1
+		if self.midinotesdown == 1:
+			self.currentchord = [m.pitch]
+			self.panel.set_scale_by_name("Using Chord from MIDI Input")
+		else:
+			self.currentchord.append(m.pitch)
+		self.scalecurrent = self.currentchord
+		self.make_scalenotes()
 
-		if isinstance(m,NoteOn):
-			self.midinotesdown += 1
-			if self.midinotesdown == 1:
-				self.currentchord = [m.pitch]
-				self.panel.set_scale_by_name("Using Chord from MIDI Input")
-			else:
-				self.currentchord.append(m.pitch)
-			self.scalecurrent = self.currentchord
-			self.make_scalenotes()
-
-		elif isinstance(m,NoteOff):
-			self.midinotesdown -= 1
+	def midinoteoff(self,msg,data):
+		if self.debug > 0:
+			print("MIDI INPUT = %s" % str(msg))
+		self.midinotesdown -= 1
 
-		elif isinstance(m,Controller):
-			if self.midiout:
-				self.midiout.schedule(m)
+	def midicontroller(self,msg,data):
+		if self.debug > 0:
+			print("MIDI INPUT = %s" % str(msg))
+		if self.midiout:
+			self.midiout.schedule(msg.midimsg)
 
 	def playnote(self,tm,sid,pitch,dur,ch,vel):
 		if self.debug > 0:
@@ -690,7 +721,7 @@ class MidiFingers(QtGui.QWidget):
 			lasty = 999.0
 			lastz = 999.0
 
-		now = time.time()
+		now = Midi.time_now()
 
 		if self.debug > 0:
 			print "cursormove sid=%d hand=%d scaledpos=%s" % (f.id,f.hand.id,scaledpos)
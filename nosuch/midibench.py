@@ -0,0 +1,1206 @@
+"""
+This module provides benchmarks for the MIDI scheduling machinery.
+
+Run it with:  python -m nosuch.midibench
+"""
+
+import os
+import sys
+import time
+import random
+import heapq
+import itertools
+
+from collections import deque
+
+from nosuch.midiutil import *
+
+if sys.platform == "win32":
+	bench_clock = time.clock
+else:
+	bench_clock = time.time
+
+def report(label,secs,n):
+	print "%-40s %10.3f usec/op" % (label,(secs * 1000000.0) / n)
+
+def cpu_time():
+	t = os.times()
+	return t[0] + t[1]
+
+class BenchOutput(MidiBaseHardwareOutput):
+	"""
+	A fake output that records when each message was written.
+	"""
+
+	def __init__(self,name="bench"):
+		self.name = name
+		self.written = []
+
+	def is_open(self):
+		return True
+
+	def open(self):
+		if Midi.oneThread:
+			Midi.oneThread._add_midiout(self)
+
+	def close(self):
+		if Midi.oneThread:
+			Midi.oneThread._remove_midiout(self)
+
+	def write_short(self,*bytes):
+		self.written.append((Midi.time_now(),bytes))
+
+	def write_sysex(self,bytes):
+		self.written.append((Midi.time_now(),bytes))
+
+class BenchHardware(MidiBaseHardware):
+	"""
+	Hardware whose outputs are BenchOutputs, for use in the MIDI
+	engine process.
+	"""
+
+	def output_devices(self):
+		return ["bench"]
+
+	def get_output(self,output_name="bench",latency=0):
+		return BenchOutput(output_name)
+
+class RecordingOutput(BenchOutput):
+	"""
+	A fake output that records the message objects it is given.
+	"""
+
+	def write_msg(self,msg):
+		self.written.append((Midi.time_now(),msg))
+
+class BenchInput(MidiBaseHardwareInput):
+	"""
+	A fake input with PortMidi's poll/read interface, whose events
+	are supplied with feed().
+	"""
+
+	def __init__(self,name="benchin"):
+		self.name = name
+		self.sysex = None
+		self.packets = deque()
+
+	def is_open(self):
+		return True
+
+	def feed(self,packets,tm=0):
+		# append is atomic, so this can be called from any thread
+		for p in packets:
+			self.packets.append([p,tm])
+
+	def poll(self):
+		return len(self.packets) > 0
+
+	def read(self,n):
+		d = []
+		packets = self.packets
+		while n > 0 and len(packets) > 0:
+			d.append(packets.popleft())
+			n -= 1
+		return d
+
+class StampedBenchInput(BenchInput):
+	"""
+	A BenchInput whose events keep the times they were fed with.
+	"""
+
+	def event_time(self,tm,clock):
+		return tm
+
+class ByteStreamOutput(BenchOutput):
+	"""
+	A fake raw byte-stream output (like a serial port), which
+	gets running status.
+	"""
+
+	def __init__(self,name="bytes"):
+		BenchOutput.__init__(self,name)
+		self.nbytes = 0
+
+	def write_bytes(self,bytes):
+		self.nbytes += len(bytes)
+
+class SlowOutput(BenchOutput):
+	"""
+	A fake output whose writes block, like a USB interface hiccup.
+	"""
+
+	def __init__(self,name="slow",delay=0.015):
+		BenchOutput.__init__(self,name)
+		self.delay = delay
+
+	def write_short(self,*bytes):
+		sleep(self.delay)
+		BenchOutput.write_short(self,*bytes)
+
+class TimestampedBenchOutput(BenchOutput):
+	"""
+	A fake timestamped output, opened with a latency in milliseconds,
+	that records when it was handed each message and the time the
+	message was meant to go out.  It doesn't send anything, so it
+	can only show how far ahead messages were handed over, not how
+	accurately they'd go out.
+	"""
+
+	timestamped = True
+
+	def __init__(self,output_name,latency=0):
+		BenchOutput.__init__(self,output_name)
+		self.latency = latency
+
+	def write_msg_at(self,msg,tm):
+		self.written.append((Midi.time_now(),tm))
+
+def timing_summary(label,late):
+	late = sorted(late)
+	n = len(late)
+	if n == 0:
+		print "%-40s no events" % label
+		return
+	print "%-40s n=%d mean=%.3fms p50=%.3fms p99=%.3fms max=%.3fms" % (
+		label,n,1000.0*sum(late)/n,1000.0*late[n/2],
+		1000.0*late[min(n-1,int(n*0.99))],1000.0*late[-1])
+
+def fill_queue(q,depth,now=0.0):
+	for i in range(depth):
+		q.push(ScheduledMidiMsg(now+random.uniform(0.0,10.0),NoteOn(pitch=60)))
+
+def bench_schedule_queue(qtype,depth,nops=2000,batch=10):
+	"""
+	Time insert and dispatch on a queue holding about depth entries.
+	Inserts and pops are done in small batches, so the depth stays
+	roughly constant.
+	"""
+	q = schedule_queue_types[qtype]()
+	fill_queue(q,depth)
+	msgs = [ScheduledMidiMsg(random.uniform(0.0,10.0),NoteOn(pitch=60))
+			for i in range(nops)]
+	tinsert = 0.0
+	tdispatch = 0.0
+	for i in range(0,nops,batch):
+		t0 = bench_clock()
+		for m in msgs[i:i+batch]:
+			q.push(m)
+		t1 = bench_clock()
+		for m in msgs[i:i+batch]:
+			q.pop()
+		t2 = bench_clock()
+		tinsert += (t1 - t0)
+		tdispatch += (t2 - t1)
+	report("%s depth=%d insert" % (qtype,depth),tinsert,nops)
+	report("%s depth=%d dispatch" % (qtype,depth),tdispatch,nops)
+
+def check_ordering(qtype,n=5000):
+	"""
+	Verify that a queue comes out in time order, with equal
+	times in insertion order.
+	"""
+	q = schedule_queue_types[qtype]()
+	msgs = []
+	for i in range(n):
+		# Coarse times so that plenty of them are equal, spread
+		# far enough to go past the end of a timing wheel
+		tm = random.randint(0,1000) / 100.0
+		m = ScheduledMidiMsg(tm,NoteOn(pitch=60))
+		m.order = i
+		msgs.append(m)
+		q.push(m)
+	out = []
+	while len(q) > 0:
+		out.append(q.pop())
+	expected = sorted(msgs,key=lambda m: (m.time,m.order))
+	if [m.order for m in out] != [m.order for m in expected]:
+		print "%s: ORDERING FAILED" % qtype
+		return False
+	print "%s: ordering ok (%d events)" % (qtype,n)
+	return True
+
+def bench_wakeup(wakeup,idlesecs=2.0,nevents=200):
+	"""
+	Measure idle CPU usage and dispatch lateness of a MidiThread
+	in the given wakeup mode.
+	"""
+	t = MidiThread(wakeup=wakeup)
+	t.start()
+	c0 = cpu_time()
+	sleep(idlesecs)
+	c1 = cpu_time()
+	print "%-40s %.1f%% of one CPU" % ("wakeup=%s idle" % wakeup,
+		100.0*(c1-c0)/idlesecs)
+
+	out = BenchOutput()
+	now = Midi.time_now()
+	times = sorted([now + random.uniform(0.05,2.0) for i in range(nevents)])
+	for tm in times:
+		t.schedule(out,NoteOn(pitch=60),tm)
+	sleep(2.2)
+	late = [w[0] - tm for (w,tm) in zip(out.written,times)]
+	timing_summary("wakeup=%s scheduled-ahead" % wakeup,late)
+
+	# Events scheduled for "now" from another thread, which
+	# measures how quickly a sleeping thread notices them.
+	out = BenchOutput()
+	times = []
+	for i in range(50):
+		sleep(random.uniform(0.01,0.05))
+		tm = Midi.time_now()
+		times.append(tm)
+		t.schedule(out,NoteOn(pitch=60),tm)
+	sleep(0.2)
+	late = [w[0] - tm for (w,tm) in zip(out.written,times)]
+	timing_summary("wakeup=%s scheduled-now" % wakeup,late)
+
+	t.keepgoing = False
+	t._wake()
+	t.join()
+
+def bench_producers(submit,nproducers=4,nevents=5000):
+	"""
+	Stress test: several threads schedule events concurrently while
+	the MidiThread dispatches them.  Check that nothing is lost or
+	reordered, and report how long each schedule() call takes.
+	"""
+	t = MidiThread(submit=submit)
+	t.start()
+	out = RecordingOutput()
+	costs = []
+
+	def producer(pid):
+		mycosts = []
+		for i in range(nevents):
+			m = Controller(controller=pid,value=i % 128)
+			m.order = (pid,i)
+			c0 = bench_clock()
+			t.schedule(out,m,Midi.time_now())
+			mycosts.append(bench_clock() - c0)
+		costs.extend(mycosts)
+
+	threads = [Thread(target=producer,args=(pid,))
+			for pid in range(nproducers)]
+	for th in threads:
+		th.start()
+	for th in threads:
+		th.join()
+	while t.num_scheduled() > 0:
+		sleep(0.01)
+	t.keepgoing = False
+	t.join()
+
+	ok = True
+	if len(out.written) != nproducers * nevents:
+		print "submit=%s: LOST EVENTS, got %d of %d" % (
+			submit,len(out.written),nproducers*nevents)
+		ok = False
+	last = {}
+	for (tm,m) in out.written:
+		pid,i = m.order
+		if i <= last.get(pid,-1):
+			ok = False
+		last[pid] = i
+	if not ok:
+		print "submit=%s: EVENTS LOST OR REORDERED" % submit
+	else:
+		print "submit=%s: %d producers, %d events, none lost or reordered" % (
+			submit,nproducers,len(out.written))
+	timing_summary("submit=%s producer schedule() cost" % submit,costs)
+	return ok
+
+def check_interleaved(qtype,n=20000):
+	"""
+	Verify ordering while time advances, with inserts and dispatches
+	interleaved the way MidiThread does them (checking next_time
+	after each insert).  Some events are pushed just ahead of now,
+	which can be behind a timing wheel's cursor.
+	"""
+	# A case that moves a timing wheel's cursor back to the tick
+	# of an event that's already waiting
+	q = schedule_queue_types[qtype]()
+	for tm in [691.669188, 687.564499, 687.619970]:
+		q.push(ScheduledMidiMsg(tm,NoteOn(pitch=60)))
+		q.next_time()
+	while q.next_time() <= 687.5678:
+		q.pop()
+	q.push(ScheduledMidiMsg(687.619679,NoteOn(pitch=60)))
+	q.next_time()
+	out = []
+	while len(q) > 0:
+		out.append(q.pop().time)
+	if out != [687.619679, 687.619970, 691.669188]:
+		print "%s: BEHIND CURSOR ORDERING FAILED %s" % (qtype,out)
+		return False
+
+	q = schedule_queue_types[qtype]()
+	now = 1000.0
+	last = None
+	npopped = 0
+	for i in range(n):
+		now += 0.001
+		if i % 2 == 0:
+			tm = now + random.uniform(0.0,6.0)
+		else:
+			tm = now + random.uniform(0.0,0.01)
+		q.push(ScheduledMidiMsg(tm,NoteOn(pitch=60)))
+		q.next_time()
+		while q.next_time() != None and q.next_time() <= now:
+			m = q.pop()
+			if last != None and m.time < last:
+				print "%s: INTERLEAVED ORDERING FAILED" % qtype
+				return False
+			last = m.time
+			npopped += 1
+	while len(q) > 0:
+		m = q.pop()
+		if m.time < last:
+			print "%s: INTERLEAVED ORDERING FAILED" % qtype
+			return False
+		last = m.time
+		npopped += 1
+	if npopped != n:
+		print "%s: INTERLEAVED LOST EVENTS" % qtype
+		return False
+	print "%s: interleaved ordering ok (%d events)" % (qtype,n)
+	return True
+
+def bench_noteoff_workload(qtype,depth,nops=20000):
+	"""
+	Steady state with depth pending events, nearly all of them
+	note-offs a few seconds ahead, as time advances and due
+	events are dispatched.
+	"""
+	q = schedule_queue_types[qtype]()
+	now = 1000.0
+	for i in range(depth):
+		q.push(ScheduledMidiMsg(now+random.uniform(0.0,3.0),NoteOff(pitch=60)))
+	# Each step inserts one event and advances time by the
+	# average spacing, so the depth stays about the same.
+	step = 1.5 / depth
+	msgs = [ScheduledMidiMsg(0.0,NoteOff(pitch=60)) for i in range(nops)]
+	t0 = bench_clock()
+	for m in msgs:
+		now += step
+		m.time = now + random.uniform(0.0,3.0)
+		q.push(m)
+		while q.next_time() <= now:
+			q.pop()
+	t1 = bench_clock()
+	report("%s depth=%d noteoff insert+expire" % (qtype,depth),t1-t0,nops)
+
+def bench_output_isolation(output_workers,nevents=100,spacing=0.01):
+	"""
+	Schedule events on a fast and a slow output, and report the
+	lateness on each.  Without output workers the slow output's
+	writes delay the fast one.
+	"""
+	t = MidiThread(output_workers=output_workers)
+	t.start()
+	fast = BenchOutput("fast")
+	slow = SlowOutput("slow")
+	t._add_midiout(fast)
+	t._add_midiout(slow)
+	sleep(0.05)
+	now = Midi.time_now() + 0.1
+	times = [now + i*spacing for i in range(nevents)]
+	for tm in times:
+		t.schedule(slow,NoteOn(pitch=60),tm)
+		t.schedule(fast,NoteOn(pitch=60),tm)
+	sleep(0.2 + nevents * max(spacing,slow.delay))
+	for out in [fast,slow]:
+		late = [w[0] - tm for (w,tm) in zip(out.written,times)]
+		timing_summary("workers=%s %s output lateness" % (
+			output_workers,out.name),late)
+	t.keepgoing = False
+	t.join()
+
+def bench_lookahead(latency,nevents=200):
+	"""
+	Compare dispatch in the normal way with handing messages to a
+	timestamped output opened with latency (in milliseconds), which
+	sets the lookahead.  For the timestamped output this is only a
+	check of the lookahead, how early the messages were handed over,
+	which should be about latency.  See bench_pypm_loopback for how
+	accurately they go out.
+	"""
+	t = MidiThread()
+	t.start()
+	plain = BenchOutput("plain")
+	stamped = TimestampedBenchOutput("stamped",latency)
+	t._add_midiout(plain)
+	t._add_midiout(stamped)
+	now = Midi.time_now()
+	times = sorted([now + random.uniform(0.05,2.0) for i in range(nevents)])
+	for tm in times:
+		t.schedule(plain,NoteOn(pitch=60),tm)
+		t.schedule(stamped,NoteOn(pitch=60),tm)
+	sleep(2.2)
+	late = [w[0] - tm for (w,tm) in zip(plain.written,times)]
+	timing_summary("latency=%d plain lateness" % latency,late)
+	lead = [tm - handed for (handed,tm) in stamped.written]
+	timing_summary("latency=%d stamped handed early by" % latency,lead)
+	t.keepgoing = False
+	t.join()
+
+def check_lookahead(latency=200):
+	"""
+	Check that a message held back by the lookahead can still be
+	cancelled, and that the lookahead goes back down when the
+	timestamped output that raised it is closed.
+	"""
+	t = MidiThread()
+	t.start()
+	Midi.oneThread = t
+	plain = BenchOutput("plain")
+	stamped = TimestampedBenchOutput("stamped",latency)
+	plain.open()
+	stamped.open()
+	ok = True
+	h = t.schedule(plain,NoteOn(pitch=60),Midi.time_now() + latency / 2000.0)
+	sleep(latency / 8000.0)
+	if len(t.held) != 1 or h.cancel() != 1:
+		print "lookahead: HELD MESSAGE NOT CANCELLED"
+		ok = False
+	sleep(latency / 1000.0)
+	if len(plain.written) != 0 or t.num_scheduled() != 0:
+		print "lookahead: CANCELLED HELD MESSAGE WAS SENT"
+		ok = False
+	stamped.close()
+	if t.lookahead != 0.0:
+		print "lookahead: NOT LOWERED WHEN OUTPUT CLOSED (%f)" % t.lookahead
+		ok = False
+	t.keepgoing = False
+	t._wake()
+	t.join()
+	Midi.oneThread = None
+	if ok:
+		print "lookahead: ok"
+	return ok
+
+def bench_pypm_loopback(outname,inname,latency=0,lookahead=0.0,nevents=200):
+	"""
+	Measure real output jitter through a MIDI loopback (a cable or a
+	virtual port) from outname to inname, using the PortMidi input
+	timestamps.  Run it once with latency=0 and once with a latency
+	(in milliseconds) and a lookahead (in seconds) to compare.
+	Midi must not already have been started.
+	"""
+	import pygame.pypm
+	from nosuch.midipypm import MidiPypmHardware
+	pygame.pypm.Initialize()
+	Midi.startup(lookahead=lookahead)
+	hw = MidiPypmHardware()
+	received = []
+	def cb(e,data):
+		if isinstance(e.midimsg,NoteOn):
+			received.append(e.time)
+	Midi.callback(cb,None)
+	midiin = hw.get_input(inname)
+	midiin.open()
+	midiout = hw.get_output(outname,latency)
+	midiout.open()
+	sleep(0.2)
+	# PortMidi time minus Midi time
+	offset = pygame.pypm.Time() / 1000.0 - Midi.time_now()
+	now = Midi.time_now() + 0.5
+	times = [now + i * 0.0125 for i in range(nevents)]
+	for tm in times:
+		midiout.schedule(NoteOn(pitch=60,velocity=100),tm)
+		midiout.schedule(NoteOff(pitch=60),tm+0.005)
+	sleep(1.0 + nevents * 0.0125)
+	late = [r - offset - tm for (r,tm) in zip(received,times)]
+	timing_summary("loopback latency=%d lookahead=%.3f" % (latency,lookahead),
+		late)
+	timing_summary("loopback latency=%d lookahead=%.3f jitter" % (
+		latency,lookahead),[x - min(late) for x in late])
+	Midi.shutdown()
+
+def bench_offline_render(nnotes=20000):
+	"""
+	Render a long phrase offline and report how much faster than
+	realtime it went.
+	"""
+	from nosuch.midioffline import MidiOfflineRenderer
+	r = MidiOfflineRenderer()
+	out = r.get_output()
+	p = Phrase()
+	for i in range(nnotes):
+		p.append(SequencedNote(pitch=40+(i%40),clocks=i*24,duration=20))
+	t0 = bench_clock()
+	r.schedule_many(out,p,0.0)
+	r.render()
+	t1 = bench_clock()
+	print "%-40s %d events, %.1fs of music in %.3fs (%.0fx realtime)" % (
+		"offline render",len(out.events),r.time_now(),t1-t0,
+		r.time_now()/(t1-t0))
+
+def bench_running_status(running,noteoff_as_noteon,nfingers=10,secs=60.0):
+	"""
+	Render nfingers playing sixteenth note chords at 120 bpm, with
+	the notes of alternate fingers overlapping, to a byte-stream
+	output, and report the bytes per second it takes.
+	"""
+	from nosuch.midioffline import MidiOfflineRenderer
+	r = MidiOfflineRenderer()
+	out = ByteStreamOutput()
+	r.thread.set_running_status(out,running,noteoff_as_noteon)
+	p = Phrase()
+	for i in range(int(secs * 8)):
+		for f in range(nfingers):
+			p.append(SequencedNote(pitch=40+f,clocks=i*24,
+				duration=(f%2) and 30 or 20))
+	r.schedule_many(out,p,0.0)
+	r.render()
+	print "%-40s %8.0f bytes/sec" % ("running=%s noteoff_as_noteon=%s" % (
+		running,noteoff_as_noteon),out.nbytes/r.time_now())
+
+def bench_clock_drift(secs=3600.0,bpm=137.0):
+	"""
+	Render secs of MIDI clock offline, and compare each pulse's time
+	with n * period, and with adding up the period pulse by pulse.
+	"""
+	from nosuch.midioffline import MidiOfflineRenderer
+	from nosuch.midisync import MidiClockGenerator
+	r = MidiOfflineRenderer()
+	out = r.get_output()
+	g = MidiClockGenerator(out,bpm,midithread=r.thread)
+	g.start(0.0)
+	r.render(secs)
+	period = 60.0 / (bpm * 24)
+	pulses = [tm for (tm,msg) in out.events if msg.onebyte == 0xf8]
+	drift = 0.0
+	summed = 0.0
+	sumdrift = 0.0
+	for n in range(len(pulses)):
+		drift = max(drift,abs(pulses[n] - n * period))
+		sumdrift = max(sumdrift,abs(summed - n * period))
+		summed += period
+	print "%-40s %d pulses, max error %.3gs (summed periods %.3gs)" % (
+		"clock drift over %.0fs" % secs,len(pulses),drift,sumdrift)
+
+def bench_clock_jitter(secs=5.0,bpm=120.0):
+	"""
+	Run a MIDI clock for secs in realtime, and report the jitter in
+	the pulses and how far the last one is from where it should be.
+	"""
+	from nosuch.midisync import MidiClockGenerator
+	t = MidiThread(wakeup="event")
+	t.start()
+	out = BenchOutput("clock")
+	t._add_midiout(out)
+	g = MidiClockGenerator(out,bpm,midithread=t)
+	start = Midi.time_now() + 0.1
+	g.start(start)
+	sleep(secs + 0.1)
+	g.stop()
+	sleep(0.05)
+	period = 60.0 / (bpm * 24)
+	pulses = [tm for (tm,bytes) in out.written if bytes[0] == 0xf8]
+	late = [pulses[n] - (start + n * period) for n in range(len(pulses))]
+	timing_summary("clock pulse lateness",late)
+	print "%-40s %.3fms after %d pulses" % ("clock last pulse error",
+		1000.0 * late[-1],len(pulses))
+	t.keepgoing = False
+	t._wake()
+	t.join()
+
+class OnePerPassThread(MidiThread):
+	"""
+	A MidiThread that reads inputs the way it used to, one event per
+	input on each pass of the loop.
+	"""
+
+	def _read_inputs(self):
+		for v in self.midiin.values():
+			if v and v.poll():
+				d = v.read(1)
+				self._gotmidi(v,d[0][0],d[0][1])
+
+def bench_input_batch(batch,ncontrollers=2000,sysexbytes=4096):
+	"""
+	Feed a burst of controller messages and a SysEx dump to an input
+	in one go, and report the input throughput and how long the last
+	event took to reach the callback.  batch=None reads one event on
+	each pass, as the MidiThread used to.
+	"""
+	if batch == None:
+		t = OnePerPassThread()
+	else:
+		t = MidiThread(input_batch=batch)
+	inp = BenchInput()
+	received = []
+	def callback(e,data):
+		received.append(Midi.time_now())
+	t.callback(callback,None)
+	t._add_midiin(inp)
+	t.start()
+	sleep(0.05)
+	packets = [[0xb0,1,i%128,0] for i in range(ncontrollers)]
+	dump = [0xf0] + [i%128 for i in range(sysexbytes-2)] + [EOX]
+	for i in range(0,len(dump),4):
+		p = dump[i:i+4]
+		packets.append(p + [0] * (4 - len(p)))
+	nevents = ncontrollers + 1
+	t0 = Midi.time_now()
+	inp.feed(packets)
+	while len(received) < nevents and Midi.time_now() < t0 + 30.0:
+		sleep(0.01)
+	t.keepgoing = False
+	t.join()
+	if len(received) < nevents:
+		print "%-40s only %d of %d events" % ("input batch=%s" % batch,
+			len(received),nevents)
+		return
+	secs = received[-1] - t0
+	print "%-40s %8.0f packets/sec, last event after %.1fms" % (
+		"input batch=%s" % batch,len(packets)/secs,1000.0*secs)
+
+def bench_input_delivery(delivery,nevents=100,spacing=0.01,
+		callback_secs=0.02,queue_size=16):
+	"""
+	Feed input events while output is scheduled, with an input
+	callback that's slower than the events arrive (like one that
+	updates the GUI), and report the output lateness and the number
+	of input events dropped.
+	"""
+	t = MidiThread(input_delivery=delivery,input_queue_size=queue_size)
+	inp = BenchInput()
+	out = BenchOutput()
+	def callback(e,data):
+		sleep(callback_secs)
+	t.callback(callback,None)
+	t._add_midiin(inp)
+	t._add_midiout(out)
+	t.start()
+	sleep(0.05)
+	start = Midi.time_now() + 0.05
+	times = [start + i*spacing for i in range(nevents)]
+	t.schedule_many(out,[(tm,NoteOn(pitch=60)) for tm in times])
+	for tm in times:
+		sleep(max(0.0,tm - Midi.time_now()))
+		inp.feed([[0x90,60,100,0]])
+	deadline = Midi.time_now() + 10.0
+	while len(out.written) < nevents and Midi.time_now() < deadline:
+		sleep(0.01)
+	t.keepgoing = False
+	t.join()
+	late = [w[0] - tm for (w,tm) in zip(out.written,times)]
+	timing_summary("input delivery=%s output lateness" % delivery,late)
+	c = t.get_input_counters()["benchin"]
+	print "%-40s %d of %d" % ("input delivery=%s dropped" % delivery,
+		c["dropped"],c["received"])
+
+def recorded_input(npackets,seed=1):
+	"""
+	Returns a list of input packets like those from a controller
+	being played: mostly notes and controllers, with some pitch bend,
+	pressure, clock bytes and the odd SysEx.
+	"""
+	r = random.Random(seed)
+	packets = []
+	while len(packets) < npackets:
+		x = r.random()
+		ch = r.randint(0,3)
+		if x < 0.2:
+			packets.append([0x90+ch,r.randint(36,96),r.randint(1,127),0])
+		elif x < 0.4:
+			packets.append([0x80+ch,r.randint(36,96),0,0])
+		elif x < 0.75:
+			packets.append([0xb0+ch,r.randint(1,16),r.randint(0,127),0])
+		elif x < 0.85:
+			packets.append([0xe0+ch,r.randint(0,127),r.randint(0,127),0])
+		elif x < 0.9:
+			packets.append([0xd0+ch,r.randint(0,127),0,0])
+		elif x < 0.995:
+			packets.append([0xf8,0,0,0])
+		else:
+			packets.append([0xf0,0x7d,1,2])
+			packets.append([3,4,5,6])
+			packets.append([7,EOX,0,0])
+	return packets
+
+def bench_decode(mode,npackets=100000):
+	"""
+	Decode a recorded input stream, with a callback that looks at
+	each message ("messages"), one that only looks at the event
+	times ("events"), or just a raw callback ("raw").
+	"""
+	t = MidiThread()
+	inp = BenchInput()
+	packets = recorded_input(npackets)
+	received = [0]
+	def callback(e,data):
+		received[0] += 1
+	def msgcallback(e,data):
+		received[0] += 1
+		e.midimsg.name
+	def rawcallback(ev,data):
+		received[0] += 1
+	if mode == "messages":
+		t.callback(msgcallback,None)
+	elif mode == "events":
+		t.callback(callback,None)
+	else:
+		t.rawcallback(rawcallback,None)
+	gotmidi = t._gotmidi
+	t0 = bench_clock()
+	for p in packets:
+		gotmidi(inp,p,0)
+	t1 = bench_clock()
+	print "%-40s %8.0f packets/sec (%d events)" % ("decode %s" % mode,
+		npackets/(t1-t0),received[0])
+
+def bench_input_filter(filtered,npackets=100000):
+	"""
+	Decode a recorded input stream with active sensing and timing
+	clock mixed in, with and without a filter discarding them.
+	"""
+	t = MidiThread()
+	inp = BenchInput()
+	if filtered:
+		inp.set_filter(MidiInputFilter(realtime=[0xf8,0xfe]))
+	r = random.Random(2)
+	packets = []
+	for p in recorded_input(npackets/2):
+		packets.append(p)
+		packets.append([r.choice([0xf8,0xfe]),0,0,0])
+	received = [0]
+	def callback(e,data):
+		received[0] += 1
+	t.callback(callback,None)
+	gotmidi = t._gotmidi
+	t0 = bench_clock()
+	for p in packets:
+		gotmidi(inp,p,0)
+	t1 = bench_clock()
+	nfiltered = 0
+	if filtered:
+		nfiltered = inp.filter.nfiltered()
+	print "%-40s %8.0f packets/sec (%d events, %d filtered)" % (
+		"input filter=%s" % filtered,len(packets)/(t1-t0),
+		received[0],nfiltered)
+
+def bench_router(routed,nsubs,npackets=50000):
+	"""
+	Decode a recorded input stream for nsubs consumers, each wanting
+	notes in a five note range on one channel, either subscribed
+	through the router or all checking each event in one callback.
+	"""
+	t = MidiThread()
+	inp = BenchInput()
+	packets = recorded_input(npackets)
+	received = [0]
+	def consumer(e,data):
+		received[0] += 1
+	wants = []
+	for i in range(nsubs):
+		low = 36 + (i * 5) % 60
+		wants.append((i % 4 + 1,low,low + 4))
+	if routed:
+		for (ch,low,high) in wants:
+			t.subscribe(consumer,None,types=[NoteOn,NoteOff],
+				channels=[ch],low=low,high=high)
+	else:
+		def callback(e,data):
+			m = e.midimsg
+			for (ch,low,high) in wants:
+				if isinstance(m,(NoteOn,NoteOff)) and m.channel == ch \
+						and low <= m.pitch <= high:
+					consumer(e,data)
+		t.callback(callback,None)
+	gotmidi = t._gotmidi
+	t0 = bench_clock()
+	for p in packets:
+		gotmidi(inp,p,0)
+	t1 = bench_clock()
+	print "%-40s %8.0f packets/sec (%d deliveries)" % (
+		"routed=%s subscribers=%d" % (routed,nsubs),
+		npackets/(t1-t0),received[0])
+
+def bench_batch_callback(batched,npackets=100000,perpass=64):
+	"""
+	Decode a dense controller sweep from two inputs, perpass packets
+	from each on every pass, with a callback per event or a batch
+	callback per pass.  Either way the callback keeps the latest value
+	of each controller.
+	"""
+	t = MidiThread(input_batch=perpass)
+	inputs = [StampedBenchInput("benchin1"), StampedBenchInput("benchin2")]
+	for inp in inputs:
+		t._add_midiin(inp)
+	t._update_devices()
+	values = {}
+	order = [True]
+	if batched:
+		def callback(events,data):
+			last = None
+			for e in events:
+				values[e.data1] = e.data2
+				if last != None and e.time < last:
+					order[0] = False
+				last = e.time
+		t.batchcallback(callback,None)
+	else:
+		def callback(e,data):
+			values[e.data1] = e.data2
+		t.callback(callback,None)
+	npasses = npackets / (2 * perpass)
+	elapsed = 0.0
+	for n in range(npasses):
+		for (i,inp) in enumerate(inputs):
+			for j in range(perpass):
+				tm = (n * perpass + j) * 2 + i
+				inp.packets.append([[0xb0,j%32,tm%128,0],tm])
+		t0 = bench_clock()
+		t._read_inputs()
+		elapsed += bench_clock() - t0
+	print "%-40s %8.0f packets/sec%s" % ("batch callback=%s" % batched,
+		npasses*2*perpass/elapsed,
+		(not order[0]) and " OUT OF ORDER" or "")
+
+def bench_sysex(chunk,nbytes=262144):
+	"""
+	Decode a SysEx patch dump of nbytes arriving in 4 byte packets,
+	whole or streamed in chunks of chunk bytes, and compare it with
+	a copy of itself.
+	"""
+	t = MidiThread(sysex_chunk=chunk)
+	inp = BenchInput()
+	inp.index = 0
+	dump = [0xf0] + [i%128 for i in range(nbytes-2)] + [EOX]
+	packets = []
+	for i in range(0,len(dump),4):
+		p = dump[i:i+4]
+		packets.append(p + [0] * (4 - len(p)))
+	received = []
+	def callback(e,data):
+		received.append(e.midimsg)
+	t.callback(callback,None)
+	gotmidi = t._gotmidi
+	t0 = bench_clock()
+	for p in packets:
+		gotmidi(inp,p,0)
+	t1 = bench_clock()
+	whole = SysEx()
+	for m in received:
+		whole.extend(m.bytes)
+	copy = SysEx()
+	copy.bytes = bytearray(dump)
+	t2 = bench_clock()
+	same = (whole == copy)
+	t3 = bench_clock()
+	print "%-40s %8.0f bytes/sec, %d messages, equal=%s in %.3fms" % (
+		"sysex chunk=%s" % chunk,nbytes/(t1-t0),len(received),same,
+		1000.0*(t3-t2))
+
+class BenchLoopFuture:
+	"""
+	Just enough of an asyncio future for MidiLoopEngine.
+	"""
+
+	def __init__(self):
+		self.state = "pending"
+		self.value = None
+		self.callbacks = []
+
+	def done(self):
+		return self.state != "pending"
+
+	def cancelled(self):
+		return self.state == "cancelled"
+
+	def result(self):
+		if self.state == "exception":
+			raise self.value
+		return self.value
+
+	def _finish(self,state,value):
+		if self.state != "pending":
+			raise Exception,"BenchLoopFuture is already done"
+		self.state = state
+		self.value = value
+		for f in self.callbacks:
+			f(self)
+
+	def set_result(self,v):
+		self._finish("done",v)
+
+	def set_exception(self,e):
+		self._finish("exception",e)
+
+	def cancel(self):
+		if self.state != "pending":
+			return False
+		self._finish("cancelled",None)
+		return True
+
+	def add_done_callback(self,f):
+		if self.done():
+			f(self)
+		else:
+			self.callbacks.append(f)
+
+class BenchLoopHandle:
+
+	def __init__(self,callback,args):
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+class BenchLoop:
+	"""
+	A minimal event loop on a VirtualClock, for running the
+	MidiLoopEngine without asyncio.  run_until() runs the handles
+	due up to a time, moving the clock along to each one.
+	"""
+
+	def __init__(self,clock):
+		self.clock = clock
+		self.handles = []
+		self.seq = itertools.count()
+		self.running = False
+
+	def time(self):
+		return self.clock.now
+
+	def is_running(self):
+		return self.running
+
+	def create_future(self):
+		return BenchLoopFuture()
+
+	def call_at(self,when,callback,*args):
+		h = BenchLoopHandle(callback,args)
+		heapq.heappush(self.handles,(when,self.seq.next(),h))
+		return h
+
+	def call_later(self,delay,callback,*args):
+		return self.call_at(self.clock.now + delay,callback,*args)
+
+	def call_soon(self,callback,*args):
+		return self.call_at(self.clock.now,callback,*args)
+
+	def run_until(self,until):
+		self.running = True
+		handles = self.handles
+		while len(handles) > 0 and handles[0][0] <= until:
+			(when,seq,h) = heapq.heappop(handles)
+			if when > self.clock.now:
+				self.clock.now = when
+			if not h.cancelled:
+				h.callback(*h.args)
+		if until > self.clock.now:
+			self.clock.now = until
+		self.running = False
+
+def check_loop_engine():
+	"""
+	Run the asyncio engine on a BenchLoop: scheduled messages go out
+	on time and their futures are done when they're sent, timers
+	repeat, input reaches an event iterator, and shutdown and join
+	work as with the MidiThread.
+	"""
+	from nosuch.midiloop import MidiLoopEngine
+	oldclock = Midi.clock
+	clock = VirtualClock(0.0)
+	loop = BenchLoop(clock)
+	Midi.startup(loop=loop,clock=clock)
+	ok = True
+	try:
+		out = BenchOutput("loop")
+		out.open()
+		inp = BenchInput()
+		Midi.oneThread._add_midiin(inp)
+		f1 = Midi.schedule(out,NoteOn(pitch=60),1.0)
+		# duration is in Midi.clocks_per_second clocks, so half a second
+		f2 = Midi.schedule(out,SequencedNote(pitch=62,duration=96),2.0)
+		ticks = []
+		def tick(now,tm):
+			ticks.append(tm)
+			if len(ticks) < 5:
+				return tm + 0.25
+			return None
+		Midi.schedule_callback(tick,0.5)
+		it = Midi.oneThread.events()
+		got = it.next_event()
+		loop.run_until(1.5)
+		if not f1.done() or f2.done():
+			print "loop engine: FUTURES WRONG AT 1.5"
+			ok = False
+		inp.feed([[0x90,64,100,0]])
+		loop.run_until(3.0)
+		written = [(tm,bytes[1]) for (tm,bytes) in out.written]
+		if written != [(1.0,60),(2.0,62),(2.5,62)]:
+			print "loop engine: WRONG OUTPUT %s" % written
+			ok = False
+		if not f2.done() or f2.result() == None:
+			print "loop engine: SEQUENCEDNOTE FUTURE NOT DONE"
+			ok = False
+		if ticks != [0.5,0.75,1.0,1.25,1.5]:
+			print "loop engine: WRONG TIMER TICKS %s" % ticks
+			ok = False
+		if not got.done() or got.result().midimsg.pitch != 64:
+			print "loop engine: INPUT NOT RECEIVED"
+			ok = False
+		f3 = Midi.schedule(out,NoteOn(pitch=65),10.0)
+	finally:
+		Midi.shutdown()
+		Midi.oneThread.join()
+		Midi.oneThread = None
+		Midi.clock = oldclock
+	if not f3.cancelled():
+		print "loop engine: PENDING FUTURE NOT CANCELLED AT SHUTDOWN"
+		ok = False
+	if ok:
+		print "loop engine: ok"
+	return ok
+
+def bench_timers(ntimers,nticks=200,period=0.01):
+	"""
+	Time the invocation of ntimers periodic callbacks (LFOs, clock
+	pulses), all with the same period.
+	"""
+	clock = VirtualClock(0.0)
+	t = MidiThread(clock=clock)
+	def lfo(now,tm):
+		return tm + period
+	for i in range(ntimers):
+		t.schedule_callback(lfo,period*random.random())
+	t0 = bench_clock()
+	for i in range(nticks):
+		clock.now += period
+		t._invoke_timer_callbacks(clock.now)
+	t1 = bench_clock()
+	report("timers n=%d per invocation" % ntimers,t1-t0,ntimers*nticks)
+
+def gui_load(running):
+	# Pure Python work that holds the GIL, standing in for Qt
+	# handlers and the Leap callback
+	while running[0]:
+		n = 0
+		for i in xrange(20000):
+			n += i * i
+
+def bench_process_engine(process,nevents=200):
+	"""
+	End-to-end latency from schedule() to the output write, for
+	events scheduled for immediate sending, while another thread
+	keeps the interpreter busy.
+	"""
+	if process:
+		Midi.startup(process=True,hardware="nosuch.midibench.BenchHardware")
+	else:
+		Midi.startup()
+	out = BenchHardware().get_output("bench")
+	out.open()
+	running = [True]
+	load = Thread(target=gui_load,args=(running,))
+	load.start()
+	sleep(0.1)
+	Midi.reset_stats()
+	for i in range(nevents):
+		sleep(random.uniform(0.002,0.01))
+		out.schedule(NoteOn(pitch=60),Midi.time_now())
+	sleep(0.2)
+	st = Midi.stats()["bench"]
+	running[0] = False
+	load.join()
+	Midi.shutdown()
+	Midi.oneThread.join()
+	Midi.oneThread = None
+	print "%-40s n=%d mean=%.3fms p50=%.3fms p99=%.3fms max=%.3fms" % (
+		"process=%s e2e latency under load" % process,st["count"],
+		1000.0*st["mean"],1000.0*st["p50"],1000.0*st["p99"],1000.0*st["max"])
+
+def bench_bandwidth(rate,nbursts=20,nfingers=10,spacing=0.05):
+	"""
+	Send bursts of nfingers note-offs and note-ons on the same tick,
+	like cursormove on a quantization boundary, to an output paced to
+	rate bytes per second (None for no pacing).  Reports the gaps
+	between writes, the note-off lateness, and the deferred count.
+	"""
+	t = MidiThread(wakeup="event")
+	t.start()
+	out = RecordingOutput("paced")
+	t._add_midiout(out)
+	t.set_bandwidth(rate,out)
+	sleep(0.05)
+	start = Midi.time_now() + 0.1
+	for i in range(nbursts):
+		tm = start + i * spacing
+		msgs = []
+		for f in range(nfingers):
+			msgs.append(NoteOn(pitch=40+f))
+			msgs.append(NoteOff(pitch=60+f))
+		t.schedule_many(out,msgs,tm)
+	sleep(0.2 + nbursts * spacing)
+	gaps = []
+	offlate = []
+	for i in range(1,len(out.written)):
+		gaps.append(out.written[i][0] - out.written[i-1][0])
+	for (wtm,msg) in out.written:
+		if isinstance(msg,NoteOff):
+			k = int((wtm - start) / spacing + 1e-9)
+			offlate.append(wtm - (start + k * spacing))
+	gaps = [g for g in gaps if g < spacing / 2]
+	timing_summary("rate=%s gap between writes in a burst" % rate,gaps)
+	timing_summary("rate=%s note-off lateness" % rate,offlate)
+	print "%-40s %d of %d" % ("rate=%s deferred" % rate,
+		t.get_counters(out)["deferred"],len(out.written))
+	t.keepgoing = False
+	t._wake()
+	t.join()
+
+def main():
+	check_loop_engine()
+	for qtype in sorted(schedule_queue_types.keys()):
+		check_ordering(qtype)
+		check_interleaved(qtype)
+	for depth in [10, 100, 1000, 10000]:
+		for qtype in sorted(schedule_queue_types.keys()):
+			bench_schedule_queue(qtype,depth)
+	for depth in [1000, 10000, 50000]:
+		for qtype in ["heap", "wheel"]:
+			bench_noteoff_workload(qtype,depth)
+	for wakeup in ["poll", "event"]:
+		bench_wakeup(wakeup)
+	for submit in ["lock", "queue"]:
+		bench_producers(submit)
+	for output_workers in [False, True]:
+		bench_output_isolation(output_workers)
+	check_lookahead()
+	for latency in [0, 10]:
+		bench_lookahead(latency)
+	bench_offline_render()
+	for ntimers in [10, 100, 1000]:
+		bench_timers(ntimers)
+	for process in [False, True]:
+		bench_process_engine(process)
+	for rate in [None, MIDI_WIRE_RATE]:
+		bench_bandwidth(rate)
+	for (running,noteoff_as_noteon) in [(False,False),(True,False),(True,True)]:
+		bench_running_status(running,noteoff_as_noteon)
+	bench_clock_drift()
+	bench_clock_jitter()
+	for batch in [None, 1, 64]:
+		bench_input_batch(batch)
+	for delivery in ["direct", "thread"]:
+		bench_input_delivery(delivery)
+	for mode in ["messages", "events", "raw"]:
+		bench_decode(mode)
+	for filtered in [False, True]:
+		bench_input_filter(filtered)
+	for nsubs in [1, 10, 100]:
+		for routed in [False, True]:
+			bench_router(routed,nsubs)
+	for batched in [False, True]:
+		bench_batch_callback(batched)
+	for chunk in [None, 4096]:
+		bench_sysex(chunk)
+
+if __name__ == "__main__":
+	main()
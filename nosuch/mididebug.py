@@ -83,7 +83,10 @@ class MidiDebugHardwareOutput(MidiBaseHardwareOutput):
 		print "MidiDebugHardwareOutput sysex bytes = %02x %02x %02x ..." % (bytes[0],bytes[1],bytes[2])
 
 	def schedule(self,msg,time=None):
-		Midi.schedule(self,msg,time)
+		return Midi.schedule(self,msg,time)
+
+	def schedule_many(self,msgs,time=None):
+		return Midi.schedule_many(self,msgs,time)
 
 	def __str__(self):
 		return 'MidiOutput(name="debug")'
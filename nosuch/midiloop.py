@@ -0,0 +1,359 @@
+"""
+This module runs the MIDI scheduler and device I/O on an asyncio
+event loop, for programs that are built around one, instead of in a
+MidiThread of their own.
+
+It's used through Midi.startup(loop=loop) (loop=None uses the
+current event loop), after which Midi.schedule and Midi.schedule_many
+return futures, so they can be awaited:
+
+	await Midi.schedule(output,NoteOn(60))
+
+and incoming MidiEvents can be read with:
+
+	async for e in Midi.oneThread.events():
+		...
+
+The MidiMsg classes and hardware backends are the same as with the
+MidiThread.  Dispatch and timer callbacks run as handles scheduled
+with loop.call_at for their deadlines, and open inputs are polled
+with loop.call_later every poll_interval.
+
+The engine's methods must be called from the loop's thread (use
+loop.call_soon_threadsafe from others).  On Python 2 this needs the
+trollius backport of asyncio, where the futures are waited for with
+"yield From(...)" and events with "yield From(it.next_event())".
+Without either, it can still run on a loop object that's passed in,
+if that has a create_future method.
+
+After Midi.shutdown(), Midi.oneThread.join() waits for the engine to
+stop if the loop is running in another thread, otherwise it stops
+the engine there and then.
+"""
+
+import sys
+import time
+import traceback
+import heapq
+import itertools
+import thread
+import threading
+
+from collections import deque
+from traceback import format_exc
+
+try:
+	import asyncio
+except ImportError:
+	try:
+		import trollius as asyncio
+	except ImportError:
+		# Only a loop that's passed in can be used, see
+		# MidiLoopEngine._new_future
+		asyncio = None
+
+from nosuch.midiutil import *
+
+try:
+	StopAsyncIteration
+except NameError:
+	class StopAsyncIteration(Exception):
+		pass
+
+class MidiLoopTimer(TimerEvent):
+	"""
+	A TimerEvent whose invocations are scheduled on the event loop.
+	"""
+
+	def __init__(self,engine,tm,func,*args,**kwargs):
+		TimerEvent.__init__(self,tm,func,*args,**kwargs)
+		self.engine = engine
+		self.handle = None
+
+	def cancel(self):
+		TimerEvent.cancel(self)
+		if self.handle:
+			self.handle.cancel()
+			self.handle = None
+
+class MidiEventIterator:
+	"""
+	An asynchronous iterator of the MidiEvents received after it was
+	created.  Up to maxlen events are buffered, after that the oldest
+	are dropped (and counted in dropped).
+	"""
+
+	def __init__(self,engine,maxlen=1000):
+		self.engine = engine
+		self.events = deque()
+		self.maxlen = maxlen
+		self.dropped = 0
+		self.waiter = None
+		self.closed = False
+
+	def __aiter__(self):
+		return self
+
+	def __anext__(self):
+		return self.next_event()
+
+	def next_event(self):
+		"""
+		Returns a future for the next MidiEvent.  Once the iterator
+		is closed it raises StopAsyncIteration.
+		"""
+		f = self.engine._new_future()
+		if len(self.events) > 0:
+			f.set_result(self.events.popleft())
+		elif self.closed:
+			f.set_exception(StopAsyncIteration())
+		else:
+			self.waiter = f
+		return f
+
+	def _put(self,e):
+		w = self.waiter
+		if w != None:
+			self.waiter = None
+			if not w.done():
+				w.set_result(e)
+				return
+		if len(self.events) >= self.maxlen:
+			self.events.popleft()
+			self.dropped += 1
+		self.events.append(e)
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.engine._remove_iterator(self)
+		w = self.waiter
+		self.waiter = None
+		if w != None and not w.done():
+			w.set_exception(StopAsyncIteration())
+
+class MidiLoopEngine(MidiThread):
+	"""
+	Takes the place of the MidiThread, doing its work in event loop
+	callbacks.  start() arranges for them, it doesn't start a thread.
+	"""
+
+	def __init__(self,loop=None,**kwargs):
+		MidiThread.__init__(self,**kwargs)
+		if loop == None:
+			if asyncio == None:
+				raise Exception,"MidiLoopEngine needs asyncio or trollius, or a loop"
+			loop = asyncio.get_event_loop()
+		self.loop = loop
+		self.started = False
+		self.stopped = threading.Event()
+		self.loop_thread = None   # the thread the loop last ran us in
+		self.dispatch_handle = None
+		self.dispatch_time = None
+		self.poll_handle = None
+		# (time,seq,future,ScheduleHandle) for the futures returned
+		# by schedule, resolved once time has been reached.
+		self.completions = []
+		self.completion_seq = itertools.count()
+		self.iterators = []
+
+	def start(self):
+		self.started = True
+		self.loop.call_soon(self._run)
+
+	def _new_future(self):
+		if hasattr(self.loop,"create_future") or asyncio == None:
+			return self.loop.create_future()
+		return asyncio.Future(loop=self.loop)
+
+	def _loop_time(self,tm):
+		# Convert a time on our clock to the loop's clock
+		return self.loop.time() + (tm - self.clock.time_now())
+
+	def _wake(self,tm=None):
+		if self.started:
+			self._arm()
+
+	def _arm(self):
+		# Make sure _run is called by the next deadline, and that
+		# inputs are being polled if there are any.
+		if not self.keepgoing:
+			if self.dispatch_handle:
+				self.dispatch_handle.cancel()
+			self.dispatch_handle = self.loop.call_soon(self._run)
+			self.dispatch_time = None
+			return
+		deadline = self._next_deadline()
+		if len(self.completions) > 0:
+			if deadline == None or self.completions[0][0] < deadline:
+				deadline = self.completions[0][0]
+		if deadline != None:
+			if self.dispatch_handle == None or deadline < self.dispatch_time:
+				if self.dispatch_handle:
+					self.dispatch_handle.cancel()
+				self.dispatch_time = deadline
+				self.dispatch_handle = self.loop.call_at(
+					self._loop_time(deadline),self._run)
+		if self.poll_handle == None and (self.midiin or self.midiin_add):
+			self.poll_handle = self.loop.call_later(self.poll_interval,
+				self._poll_inputs)
+
+	def join(self,timeout=None):
+		"""
+		Once keepgoing is False (e.g. after Midi.shutdown()), wait
+		up to timeout seconds for the engine to stop, if the loop is
+		running in another thread.  Otherwise stop it now.
+		"""
+		if not self.started or self.stopped.isSet():
+			return
+		running = getattr(self.loop,"is_running",lambda: False)()
+		if running and self.loop_thread != thread.get_ident():
+			self.stopped.wait(timeout)
+		elif not self.keepgoing:
+			self._stop()
+
+	def _run(self):
+		self.loop_thread = thread.get_ident()
+		self.dispatch_handle = None
+		self.dispatch_time = None
+		if not self.keepgoing:
+			self._stop()
+			return
+		now = self.clock.time_now()
+		self.timenow = now
+		self._poll_sources()
+		self._update_devices()
+		if self._is_due(now):
+			self._send_scheduled(now)
+		completions = self.completions
+		while len(completions) > 0 and completions[0][0] <= now:
+			(tm,seq,f,handle) = heapq.heappop(completions)
+			if not f.done():
+				f.set_result(handle)
+		self._arm()
+
+	def _poll_inputs(self):
+		self.loop_thread = thread.get_ident()
+		self.poll_handle = None
+		if not self.keepgoing:
+			return
+		self.timenow = self.clock.time_now()
+		self._update_devices()
+		self._read_inputs()
+		if len(self.midiin) > 0:
+			self.poll_handle = self.loop.call_later(self.poll_interval,
+				self._poll_inputs)
+
+	def _stop(self):
+		if self.stopped.isSet():
+			return
+		if self.dispatch_handle:
+			self.dispatch_handle.cancel()
+			self.dispatch_handle = None
+		if self.poll_handle:
+			self.poll_handle.cancel()
+			self.poll_handle = None
+		self._close_devices()
+		self._stop_callback_worker()
+		completions = self.completions
+		self.completions = []
+		for (tm,seq,f,handle) in completions:
+			handle.cancel()
+			f.cancel()
+		for it in list(self.iterators):
+			it.close()
+		self.stopped.set()
+
+	def _complete_when_sent(self,handle):
+		# Returns a future that's done, with handle as its result,
+		# once the last of handle's messages is due.  Cancelling the
+		# future cancels the messages.
+		f = self._new_future()
+		if len(handle.msgs) == 0:
+			f.set_result(handle)
+			return f
+		tm = max([m.time for m in handle.msgs])
+		heapq.heappush(self.completions,
+			(tm,self.completion_seq.next(),f,handle))
+		f.add_done_callback(self._completion_done)
+		self._arm()
+		return f
+
+	def _completion_done(self,f):
+		if not f.cancelled():
+			return
+		for e in self.completions:
+			if e[2] is f:
+				e[3].cancel()
+				self.completions.remove(e)
+				heapq.heapify(self.completions)
+				break
+
+	def schedule(self,output,msg,time=None):
+		"""
+		Schedule msg as MidiThread.schedule does.  Returns a future
+		that's done when the message has been sent (or, for a
+		SequencedNote, its NoteOff), whose result is the
+		ScheduleHandle.
+		"""
+		handle = MidiThread.schedule(self,output,msg,time)
+		return self._complete_when_sent(handle)
+
+	def schedule_many(self,output,msgs,time=None):
+		"""
+		Schedule msgs as MidiThread.schedule_many does, returning a
+		future that's done when the last of them has been sent.
+		"""
+		handle = MidiThread.schedule_many(self,output,msgs,time)
+		return self._complete_when_sent(handle)
+
+	def schedule_callback(self,func,time=None,*args,**kwargs):
+		"""
+		As MidiThread.schedule_callback, but the callback runs in a
+		handle on the event loop.  Returns a MidiLoopTimer, whose
+		cancel() cancels the handle.
+		"""
+		if time is None:
+			time = self.clock.time_now()
+		t = MidiLoopTimer(self,time,func,*args,**kwargs)
+		t.handle = self.loop.call_at(self._loop_time(time),self._fire_timer,t)
+		return t
+
+	def _fire_timer(self,t):
+		t.handle = None
+		if t.cancelled or not self.keepgoing:
+			return
+		try:
+			nextTime = t.invoke(self.clock.time_now())
+		except:
+			print "Error invoking scheduled callback: %s" % format_exc()
+			return
+		if nextTime and not t.cancelled:
+			t.handle = self.loop.call_at(self._loop_time(nextTime),
+				self._fire_timer,t)
+
+	def events(self,maxlen=1000):
+		"""
+		Returns a MidiEventIterator of the incoming MidiEvents.
+		Each iterator gets every event; the Midi.callback function,
+		if set, is still called too.
+		"""
+		it = MidiEventIterator(self,maxlen)
+		if not self.keepgoing:
+			it.close()
+		else:
+			self.iterators.append(it)
+		return it
+
+	def _remove_iterator(self,it):
+		if it in self.iterators:
+			self.iterators.remove(it)
+
+	def _wants_events(self):
+		return MidiThread._wants_events(self) or len(self.iterators) > 0
+
+	def _push_input_event(self,e,device):
+		MidiThread._push_input_event(self,e,device)
+		for it in self.iterators:
+			it._put(e)
@@ -0,0 +1,156 @@
+"""
+This module provides offline (faster than realtime) rendering of
+scheduled MIDI, into memory or a Standard MIDI File.
+"""
+
+import sys
+import time
+import traceback
+import string
+
+from traceback import format_exc
+
+from nosuch.midifile import putNumber, putVariableLengthNumber
+from nosuch.midiutil import *
+
+class MidiOfflineHardwareOutput(MidiBaseHardwareOutput):
+	"""
+	An output that records each message, with the time it was
+	written, in its events list.
+	"""
+
+	def __init__(self,output_name,renderer):
+		self.name = output_name
+		self.renderer = renderer
+		self.events = []
+
+	def is_open(self):
+		return True
+
+	def open(self):
+		pass
+
+	def close(self):
+		pass
+
+	def write_msg(self,msg):
+		self.events.append((self.renderer.clock.time_now(),msg))
+
+	def schedule(self,msg,time=None):
+		return self.renderer.schedule(self,msg,time)
+
+	def schedule_many(self,msgs,time=None):
+		return self.renderer.schedule_many(self,msgs,time)
+
+	def to_midifile_str(self,start=None,running_status=False):
+		"""
+		Returns the recorded events as a format 0 Standard MIDI File,
+		at Midi.clocks_per_second ticks per second (96 per quarter
+		note at 120 bpm).  Realtime messages are left out.  With
+		running_status, repeated status bytes are left out too.
+		"""
+		if start == None:
+			start = self.renderer.start
+		encoder = MidiRunningStatusEncoder(running=running_status)
+		division = 96
+		ticks_per_second = Midi.clocks_per_second
+		trk = []
+		lastticks = 0
+		for (tm,msg) in self.events:
+			if isinstance(msg,RealTime):
+				continue
+			ticks = int(round((tm - start) * ticks_per_second))
+			if ticks < lastticks:
+				ticks = lastticks
+			bytes = encoder.encode(msg)
+			trk.append(putVariableLengthNumber(ticks - lastticks))
+			if isinstance(msg,SysEx):
+				trk.append(chr(0xf0))
+				trk.append(putVariableLengthNumber(len(bytes) - 1))
+				trk.append(string.join([chr(b) for b in bytes[1:]],""))
+			else:
+				trk.append(string.join([chr(b) for b in bytes],""))
+			lastticks = ticks
+		# end of track
+		trk.append(putVariableLengthNumber(0) + "\xff\x2f\x00")
+		trkstr = string.join(trk,"")
+		# 120 bpm, which is what Midi.clocks_per_second assumes
+		tempo = "\x00\xff\x51\x03" + putNumber(500000,3)
+		trkstr = tempo + trkstr
+		s = "MThd" + putNumber(6,4) + putNumber(0,2)
+		s = s + putNumber(1,2) + putNumber(division,2)
+		s = s + "MTrk" + putNumber(len(trkstr),4) + trkstr
+		return s
+
+	def write_midifile(self,path,start=None,running_status=False):
+		f = open(path,"wb")
+		try:
+			f.write(self.to_midifile_str(start,running_status))
+		finally:
+			f.close()
+
+	def __str__(self):
+		return 'MidiOutput(name="%s" offline)' % (self.name)
+
+	def to_xml(self):
+		return '<midi_output name="%s" offline="1"/>' % (self.name)
+
+class MidiOfflineRenderer:
+	"""
+	Runs the MidiThread dispatch logic against a VirtualClock, jumping
+	straight from one deadline to the next rather than waiting for it.
+	The thread is never started, so this doesn't need (or disturb)
+	Midi.startup().
+	"""
+
+	def __init__(self,start=0.0,scheduler="heap"):
+		self.start = float(start)
+		self.clock = VirtualClock(start)
+		self.thread = MidiThread(scheduler=scheduler,clock=self.clock)
+
+	def get_output(self,output_name="offline"):
+		return MidiOfflineHardwareOutput(output_name,self)
+
+	def time_now(self):
+		return self.clock.time_now()
+
+	def schedule(self,output,msg,time=None):
+		if time == None:
+			time = self.clock.time_now()
+		return self.thread.schedule(output,msg,time)
+
+	def schedule_many(self,output,msgs,time=None):
+		if time == None:
+			time = self.clock.time_now()
+		return self.thread.schedule_many(output,msgs,time)
+
+	def schedule_callback(self,func,time=None,*args,**kwargs):
+		if time == None:
+			time = self.clock.time_now()
+		return self.thread.schedule_callback(func,time,*args,**kwargs)
+
+	def render(self,until=None):
+		"""
+		Dispatch everything scheduled up to until (or everything, if
+		until is None), and leave the clock at until.  Pass until
+		if there are callbacks that keep rescheduling themselves.
+		"""
+		t = self.thread
+		while True:
+			t._poll_sources()
+			deadline = t._next_deadline()
+			if deadline == None:
+				break
+			if until != None and deadline > until:
+				break
+			# Set the clock directly, VirtualClock.set would
+			# wake Midi.oneThread.
+			if deadline > self.clock.now:
+				self.clock.now = deadline
+			now = self.clock.now
+			t.timenow = now
+			t._send_scheduled(now)
+			if t._next_timer != None and t._next_timer <= now:
+				t._invoke_timer_callbacks(now)
+		if until != None and until > self.clock.now:
+			self.clock.now = until
@@ -0,0 +1,546 @@
+"""
+This module runs the MIDI scheduler and device I/O in a separate
+process, so that long-running Python code in the GUI or Leap threads
+(and the GIL they hold) can't delay MIDI output.
+
+It's used through Midi.startup(process=True), optionally with
+hardware="module.ClassName" naming the hardware class to use in the
+engine process (the default is nosuch.midipypm.MidiPypmHardware).
+Midi.schedule, Midi.callback, Midi.schedule_callback and the device
+open/close methods work as usual.  Timer callbacks and the input
+callback run in this process.
+
+Short messages go to and from the engine process through shared
+memory ring buffers of packed events.  SysEx and device control go
+through a pipe.
+
+Each scheduled message is sent with an id, which ScheduleHandle.cancel
+sends back to the engine (and waits for the number cancelled).
+
+Limitations: num_scheduled() only counts messages the engine hasn't
+picked up yet, and the clock must be one that both processes can read
+(a VirtualClock won't do).
+"""
+
+import sys
+import time
+import traceback
+import thread
+import threading
+import struct
+import itertools
+import multiprocessing
+
+from ctypes import c_char, c_long
+from time import sleep
+from traceback import format_exc
+
+from nosuch.midiutil import *
+
+KIND_SHORT = 0
+KIND_REALTIME = 1    # for the engine's high-priority lane
+
+class MidiEventRing:
+	"""
+	A single-producer, single-consumer ring buffer of packed events
+	in shared memory.  Each event is a time, a port id, a kind, four
+	MIDI bytes and a message id (0 for none).
+	"""
+
+	record = struct.Struct("<dHBBBBBxI")
+
+	def __init__(self,nrecords=4096):
+		self.nrecords = nrecords
+		self.buf = multiprocessing.RawArray(c_char,nrecords * self.record.size)
+		# head is only written by the producer, tail by the consumer
+		self.head = multiprocessing.RawValue(c_long,0)
+		self.tail = multiprocessing.RawValue(c_long,0)
+
+	def pending(self):
+		return self.head.value - self.tail.value
+
+	def put(self,tm,port,kind,b0,b1=0,b2=0,b3=0,id=0):
+		# Returns False if the ring is full
+		h = self.head.value
+		if h - self.tail.value >= self.nrecords:
+			return False
+		self.record.pack_into(self.buf,(h % self.nrecords) * self.record.size,
+			tm,port,kind,b0,b1,b2,b3,id)
+		self.head.value = h + 1
+		return True
+
+	def get_all(self):
+		# Returns a list of (time,port,kind,b0,b1,b2,b3,id) tuples
+		t = self.tail.value
+		h = self.head.value
+		if t == h:
+			return []
+		events = []
+		size = self.record.size
+		n = self.nrecords
+		while t < h:
+			events.append(self.record.unpack_from(self.buf,(t % n) * size))
+			t += 1
+		self.tail.value = t
+		return events
+
+def midimsg_from_bytes(b0,b1,b2):
+	"""
+	Build a message from the bytes written for it, the inverse of
+	midimsg_bytes for short messages.
+	"""
+	if b0 >= 0xf8:
+		return RealTime(b0)
+	ch = (b0 & 0x0f) + 1
+	hi = b0 & 0xf0
+	if hi == 0x90:
+		return NoteOn(channel=ch,pitch=b1,velocity=b2)
+	if hi == 0x80:
+		return NoteOff(channel=ch,pitch=b1,velocity=b2)
+	if hi == 0xa0:
+		return Pressure(channel=ch,pitch=b1,pressure=b2)
+	if hi == 0xb0:
+		return Controller(channel=ch,controller=b1,value=b2)
+	if hi == 0xc0:
+		# Program numbers are 1-based, see Program.write
+		return Program(channel=ch,program=b1+1)
+	if hi == 0xd0:
+		return ChannelPressure(channel=ch,pressure=b1)
+	if hi == 0xe0:
+		return PitchBend(channel=ch,value=b1+(b2<<7))
+	raise Exception,"midimsg_from_bytes can't handle status byte %02x" % b0
+
+def _import_class(path):
+	(modname,clsname) = path.rsplit(".",1)
+	__import__(modname)
+	return getattr(sys.modules[modname],clsname)
+
+class MidiEngineThread(MidiThread):
+	"""
+	The MidiThread in the engine process.  It takes scheduled events
+	from the output ring and control commands from the pipe, and puts
+	raw input packets on the input ring.
+	"""
+
+	def __init__(self,hardware,outring,inring,ctrl,reply,**kwargs):
+		MidiThread.__init__(self,**kwargs)
+		self.hardware = hardware
+		self.outring = outring
+		self.inring = inring
+		self.ctrl = ctrl
+		self.reply = reply
+		self.outputs = {}
+		self.inputs = {}
+		self.input_ids = {}
+		# Input events that didn't fit in the ring, by port
+		self.input_dropped = {}
+		# Our clock time minus the other process's, see
+		# MidiProcessProxy._sync
+		self.offset = 0.0
+		# The scheduled messages by id, for cancelling them.  Ones
+		# that are sent or cancelled are pruned now and then.
+		self.remote_msgs = {}
+		self.prune_at = 1024
+
+	def _poll_sources(self):
+		MidiThread._poll_sources(self)
+		# The ring first, so that a "cancel" finds what was
+		# scheduled before it
+		self._drain_outring()
+		while self.ctrl.poll():
+			self._control(self.ctrl.recv())
+
+	def _drain_outring(self):
+		events = self.outring.get_all()
+		if len(events) == 0:
+			return
+		sched = []
+		for (tm,port,kind,b0,b1,b2,b3,id) in events:
+			output = self.outputs.get(port)
+			if output == None:
+				continue
+			m = midimsg_from_bytes(b0,b1,b2)
+			s = ScheduledMidiMsg(tm+self.offset,m,output=output)
+			self._remember(id,s)
+			if kind == KIND_REALTIME:
+				self._insert_realtime(s)
+			else:
+				sched.append(s)
+		self._insert_many_in_schedule(sched)
+
+	def _remember(self,id,s):
+		msgs = self.remote_msgs
+		msgs[id] = s
+		if len(msgs) >= self.prune_at:
+			for (k,m) in msgs.items():
+				if m.dispatched or m.cancelled:
+					del msgs[k]
+			self.prune_at = max(1024,2 * len(msgs))
+
+	def _cancel_remote(self,ids):
+		# ids are (id,noteon id or 0) for each message to cancel
+		self._drain_outring()
+		msgs = []
+		for (id,noteon_id) in ids:
+			s = self.remote_msgs.get(id)
+			if s == None:
+				# Already sent and pruned
+				continue
+			if noteon_id:
+				n = self.remote_msgs.get(noteon_id)
+				if n == None:
+					# The NoteOn has been sent, leave the NoteOff
+					continue
+				s.noteon = n
+			msgs.append(s)
+		n = self._cancel(msgs)
+		for (id,noteon_id) in ids:
+			s = self.remote_msgs.get(id)
+			if s != None and s.cancelled:
+				del self.remote_msgs[id]
+		return n
+
+	def _control(self,cmd):
+		name = cmd[0]
+		try:
+			if name == "sync":
+				self.reply.send((name,self.clock.time_now()))
+			elif name == "offset":
+				self.offset = cmd[1]
+			elif name == "openoutput":
+				(port,devname,latency) = cmd[1:]
+				if latency:
+					o = self.hardware.get_output(devname,latency)
+				else:
+					o = self.hardware.get_output(devname)
+				o.open()
+				self.outputs[port] = o
+				self.reply.send((name,None))
+			elif name == "closeoutput":
+				o = self.outputs.pop(cmd[1],None)
+				if o:
+					o.close()
+			elif name == "openinput":
+				(port,devname) = cmd[1:]
+				i = self.hardware.get_input(devname)
+				i.open()
+				self.inputs[port] = i
+				self.input_ids[i] = port
+				self.reply.send((name,None))
+			elif name == "closeinput":
+				i = self.inputs.pop(cmd[1],None)
+				if i:
+					del self.input_ids[i]
+					i.close()
+			elif name == "sysex":
+				(tm,port,bytes,id) = cmd[1:]
+				output = self.outputs.get(port)
+				if output:
+					m = SysEx()
+					m.bytes = bytearray(bytes)
+					s = ScheduledMidiMsg(tm+self.offset,m,output=output)
+					self._remember(id,s)
+					self._insert_in_schedule(s)
+			elif name == "cancel":
+				self.reply.send((name,self._cancel_remote(cmd[1])))
+			elif name == "stats":
+				self.reply.send((name,self.get_stats()))
+			elif name == "resetstats":
+				self.reset_stats()
+			elif name == "bandwidth":
+				output = self.outputs.get(cmd[1])
+				if output:
+					self.set_bandwidth(cmd[2],output)
+			elif name == "latepolicy":
+				(policy,threshold,port) = cmd[1:]
+				if port == None:
+					self.set_late_policy(policy,threshold)
+				else:
+					output = self.outputs.get(port)
+					if output:
+						self.set_late_policy(policy,threshold,output)
+			elif name == "runningstatus":
+				(port,running,noteoff_as_noteon) = cmd[1:]
+				output = self.outputs.get(port)
+				if output:
+					self.set_running_status(output,running,noteoff_as_noteon)
+			elif name == "counters":
+				port = cmd[1]
+				if port == None:
+					self.reply.send((name,self.get_counters()))
+				else:
+					self.reply.send((name,
+						self.get_counters(self.outputs.get(port))))
+			elif name == "resetcounters":
+				self.reset_counters()
+			elif name == "inputdropped":
+				self.reply.send((name,dict(self.input_dropped)))
+			elif name == "resetinputdropped":
+				self.input_dropped = {}
+			elif name == "shutdown":
+				self.keepgoing = False
+		except:
+			print "Exception in MIDI engine control %s: %s" % (name,format_exc())
+			if name in ("openoutput","openinput","sync","stats",
+					"counters","inputdropped","cancel"):
+				self.reply.send((name,str(sys.exc_info()[1])))
+
+	def _gotmidi(self,device,bytes,tm):
+		# Inputs are decoded in the other process
+		secs = device.event_time(tm,self.clock) - self.offset
+		port = self.input_ids.get(device,0)
+		if not self.inring.put(secs,port,KIND_SHORT,
+				bytes[0],bytes[1],bytes[2],bytes[3]):
+			self.input_dropped[port] = self.input_dropped.get(port,0) + 1
+
+def _engine_main(hardware,outring,inring,ctrl,reply,options):
+	hw = _import_class(hardware)()
+	engine = MidiEngineThread(hw,outring,inring,ctrl,reply,**options)
+	Midi.oneThread = engine
+	# The engine loop runs in this process's main thread
+	engine.run()
+
+class MidiProcessProxy(MidiThread):
+	"""
+	Stands in for the MidiThread in this process.  Its own thread
+	runs timer callbacks and decodes input from the engine process.
+	"""
+
+	def __init__(self,hardware="nosuch.midipypm.MidiPypmHardware",
+			ringsize=4096,**kwargs):
+		# Input callbacks are called in this process
+		MidiThread.__init__(self,
+			input_delivery=kwargs.pop("input_delivery","direct"),
+			input_queue_size=kwargs.pop("input_queue_size",1000),
+			sysex_max=kwargs.pop("sysex_max",1048576),
+			sysex_chunk=kwargs.pop("sysex_chunk",None))
+		self.remote = True
+		self.outring = MidiEventRing(ringsize)
+		self.inring = MidiEventRing(ringsize)
+		(ctrl_r,self.ctrl) = multiprocessing.Pipe(False)
+		(self.reply,reply_w) = multiprocessing.Pipe(False)
+		self.ctrl_lock = thread.allocate_lock()
+		self.out_lock = thread.allocate_lock()
+		self.port_ids = {}
+		self.ports = {}
+		self.portseq = itertools.count(1)
+		self.msgseq = itertools.count(1)
+		self.process = multiprocessing.Process(target=_engine_main,
+			args=(hardware,self.outring,self.inring,ctrl_r,reply_w,kwargs))
+		self.process.daemon = True
+		self.process.start()
+		self._sync()
+
+	def _sync(self,rounds=5,timeout=30.0):
+		# Work out the engine's clock time minus ours, from the
+		# quickest of a few round trips, taking the engine's reading
+		# to be from halfway through.  The first waits for the engine
+		# to start up.
+		best = None
+		for i in range(rounds):
+			self.ctrl_lock.acquire()
+			try:
+				t0 = self.clock.time_now()
+				self.ctrl.send(("sync",))
+				if not self.reply.poll(timeout):
+					raise Exception,"MIDI engine process didn't start"
+				remote = self.reply.recv()[1]
+				t1 = self.clock.time_now()
+			finally:
+				self.ctrl_lock.release()
+			if best == None or (t1 - t0) < best[0]:
+				best = (t1 - t0,remote - (t0 + t1) / 2.0)
+		self._control(("offset",best[1]))
+
+	def _control(self,cmd,wait=False):
+		self.ctrl_lock.acquire()
+		try:
+			self.ctrl.send(cmd)
+			if wait:
+				return self.reply.recv()[1]
+		finally:
+			self.ctrl_lock.release()
+
+	def run(self):
+		try:
+			while self.keepgoing:
+				self.timenow = self.clock.time_now()
+				for (secs,port,kind,b0,b1,b2,b3,id) in self.inring.get_all():
+					device = self.ports.get(port)
+					if device:
+						self._decode_midi(device,[b0,b1,b2,b3],secs)
+				if len(self.input_batched) > 0:
+					self._flush_input_batch()
+				if self._next_timer <= self.timenow:
+					self._invoke_timer_callbacks(self.timenow)
+				sleep(self.poll_interval)
+			self._control(("shutdown",))
+			self.process.join(2.0)
+			self._stop_callback_worker()
+		except:
+			print "EXCEPTION in MidiProcessProxy.run()!? = %s" % format_exc()
+
+	def num_scheduled(self):
+		return self.outring.pending()
+
+	def get_stats(self):
+		return self._control(("stats",),wait=True)
+
+	def reset_stats(self):
+		self._control(("resetstats",))
+
+	def _port(self,output):
+		# The engine's port id for output, opening it there if need be
+		port = self.port_ids.get(output)
+		if port == None:
+			self._add_midiout(output)
+			port = self.port_ids[output]
+		return port
+
+	def set_bandwidth(self,rate,output):
+		self._control(("bandwidth",self._port(output),rate))
+
+	def set_late_policy(self,policy,threshold=None,output=None):
+		if not policy in ("send","drop","drop_noteons"):
+			raise Exception,"Unknown late policy: %s" % policy
+		port = None
+		if output != None:
+			port = self._port(output)
+		self._control(("latepolicy",policy,threshold,port))
+
+	def set_running_status(self,output,running=True,noteoff_as_noteon=False):
+		self._control(("runningstatus",self._port(output),running,
+			noteoff_as_noteon))
+
+	def get_counters(self,output=None):
+		port = None
+		if output != None:
+			port = self._port(output)
+		return self._control(("counters",port),wait=True)
+
+	def reset_counters(self):
+		self._control(("resetcounters",))
+
+	def get_input_counters(self):
+		# Inputs are decoded here, but the engine counts the events
+		# that didn't fit in the input ring
+		counters = {}
+		for (device,c) in self.input_counters.items():
+			counters[getattr(device,"name",None)] = dict(c)
+		dropped = self._control(("inputdropped",),wait=True)
+		for (port,device) in self.ports.items():
+			f = getattr(device,"filter",None)
+			n = dropped.get(port,0)
+			if f == None and n == 0:
+				continue
+			c = counters.setdefault(device.name,{"received":0, "dropped":0})
+			c["dropped"] += n
+			if f != None:
+				c["filtered"] = f.nfiltered()
+		return counters
+
+	def reset_input_counters(self):
+		self.input_counters = {}
+		self._control(("resetinputdropped",))
+
+	def schedule(self,output,msg,time=None):
+		if not output.is_open():
+			raise Exception, "schedule(): output device isn't open?"
+		if time == None:
+			time = self.timenow
+		sched = self._expand(output,msg,time)
+		self._send_out(sched)
+		return ScheduleHandle(self,sched)
+
+	def schedule_many(self,output,msgs,time=None):
+		if not output.is_open():
+			raise Exception, "schedule_many(): output device isn't open?"
+		if time == None:
+			time = self.timenow
+		sched = []
+		for msg in msgs:
+			if isinstance(msg,tuple):
+				sched.extend(self._expand(output,msg[1],msg[0]))
+			else:
+				sched.extend(self._expand(output,msg,time))
+		sched.sort(key=lambda m: m.time)
+		self._send_out(sched)
+		return ScheduleHandle(self,sched)
+
+	def schedule_realtime(self,output,msg,time=None):
+		if not output.is_open():
+			raise Exception, "schedule_realtime(): output device isn't open?"
+		if time == None:
+			time = self.timenow
+		sched = [ScheduledMidiMsg(time,msg,output=output)]
+		self._send_out(sched,KIND_REALTIME)
+		return ScheduleHandle(self,sched)
+
+	def _cancel(self,msgs):
+		ids = []
+		for m in msgs:
+			noteon = m.noteon
+			if noteon != None:
+				ids.append((m.remote_id,noteon.remote_id))
+			else:
+				ids.append((m.remote_id,0))
+		if len(ids) == 0:
+			return 0
+		return self._control(("cancel",ids),wait=True)
+
+	def _send_out(self,sched,kind=KIND_SHORT):
+		for s in sched:
+			port = self.port_ids.get(s.output)
+			if port == None:
+				# e.g. debug outputs, which don't register when opened
+				self._add_midiout(s.output)
+				port = self.port_ids[s.output]
+			s.remote_id = self._new_id()
+			bytes = midimsg_bytes(s.msg)
+			if isinstance(s.msg,SysEx):
+				# As a str, which pickles much smaller than a list
+				self._control(("sysex",s.time,port,str(bytearray(bytes)),
+					s.remote_id))
+				continue
+			bytes = bytes + [0] * (4 - len(bytes))
+			self.out_lock.acquire()
+			while not self.outring.put(s.time,port,kind,
+					bytes[0],bytes[1],bytes[2],bytes[3],s.remote_id):
+				# Full, wait for the engine to catch up
+				sleep(0.0005)
+			self.out_lock.release()
+
+	def _new_id(self):
+		# Message ids are 32 bits, and 0 means none
+		id = self.msgseq.next() & 0xffffffff
+		if id == 0:
+			id = self.msgseq.next() & 0xffffffff
+		return id
+
+	def _add_midiout(self,output):
+		port = self.portseq.next()
+		err = self._control(("openoutput",port,getattr(output,"name",None),
+			getattr(output,"latency",0)),wait=True)
+		if err:
+			raise Exception,"Unable to open output in MIDI engine: %s" % err
+		self.port_ids[output] = port
+
+	def _remove_midiout(self,output):
+		port = self.port_ids.pop(output,None)
+		if port != None:
+			self._control(("closeoutput",port))
+
+	def _add_midiin(self,input):
+		port = self.portseq.next()
+		err = self._control(("openinput",port,getattr(input,"name",None)),
+			wait=True)
+		if err:
+			raise Exception,"Unable to open input in MIDI engine: %s" % err
+		self.port_ids[input] = port
+		self.ports[port] = input
+
+	def _remove_midiin(self,input):
+		port = self.port_ids.pop(input,None)
+		if port != None:
+			del self.ports[port]
+			self._control(("closeinput",port))
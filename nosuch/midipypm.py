@@ -24,6 +24,15 @@ from pygame.pypm import CountDevices, GetDeviceInfo, GetDefaultInputDeviceID, Ge
 from nosuch.midifile import *
 from nosuch.midiutil import *
 
+class PortMidiClock(MidiClock):
+	"""
+	The PortMidi clock, which gives input timestamps and
+	output timestamps directly.
+	"""
+
+	def time_now(self):
+		return pygame.pypm.Time() / 1000.0
+
 class MidiPypmHardware(MidiBaseHardware):
 
 	def __init__(self):
@@ -63,8 +72,8 @@ class MidiPypmHardware(MidiBaseHardware):
 	def get_input(self,input_name):
 		return MidiPypmHardwareInput(input_name)
 
-	def get_output(self,output_name):
-		return MidiPypmHardwareOutput(output_name)
+	def get_output(self,output_name,latency=0):
+		return MidiPypmHardwareOutput(output_name,latency)
 
 class MidiPypmHardwareInput(MidiBaseHardwareInput):
 
@@ -93,8 +102,15 @@ class MidiPypmHardwareInput(MidiBaseHardwareInput):
 		self.inuse = found[4]
 		self.sysex = None
 		self.input = None
+		self.remote = False
 
 	def open(self):
+		if Midi.oneThread and Midi.oneThread.remote:
+			# The device is opened in the MIDI engine process
+			self.sysex = None
+			Midi.oneThread._add_midiin(self)
+			self.remote = True
+			return
 		# Get fresh value, inuse might have changed?
 		v = GetDeviceInfo(self.index)
 		if self.inuse:
@@ -110,7 +126,13 @@ class MidiPypmHardwareInput(MidiBaseHardwareInput):
 			Midi.oneThread._add_midiin(self)
 
 	def is_open(self):
-		return(self.input != None)
+		return(self.input != None or self.remote)
+
+	def event_time(self,tm,clock):
+		# tm is milliseconds on the PortMidi clock
+		if isinstance(clock,PortMidiClock):
+			return tm / 1000.0
+		return clock.time_now() - (pygame.pypm.Time() - tm) / 1000.0
 
 	def poll(self):
 		return(self.input.Poll())
@@ -119,6 +141,7 @@ class MidiPypmHardwareInput(MidiBaseHardwareInput):
 		return(self.input.Read(n))
 
 	def close(self):
+		self.remote = False
 		del self.input
 		self.input = None
 		if Midi.oneThread:
@@ -133,7 +156,14 @@ class MidiPypmHardwareInput(MidiBaseHardwareInput):
 
 class MidiPypmHardwareOutput(MidiBaseHardwareOutput):
 
-	def __init__(self,output_name):
+	def __init__(self,output_name,latency=0):
+		"""
+		If latency (in milliseconds) is non-zero, the output is
+		opened with that latency and is timestamped: MidiThread hands
+		it messages early (see its lookahead, which is at least the
+		latency) with the time they should be sent, and PortMidi
+		sends them at that time.
+		"""
 		if output_name == None:
 			n = GetDefaultOutputDeviceID()
 			found = GetDeviceInfo(n)
@@ -157,8 +187,17 @@ class MidiPypmHardwareOutput(MidiBaseHardwareOutput):
 		self.hasoutput = found[3]
 		self.inuse = found[4]
 		self.pm_output = None
+		self.latency = latency
+		self.timestamped = (latency > 0)
+		self.timestamp = None
+		self.remote = False
 
 	def open(self):
+		if Midi.oneThread and Midi.oneThread.remote:
+			# The device is opened in the MIDI engine process
+			Midi.oneThread._add_midiout(self)
+			self.remote = True
+			return
 		v = GetDeviceInfo(self.index)
 		if self.inuse:
 			raise Exception, "Device "+self.name+" is already open by something else"
@@ -167,22 +206,47 @@ class MidiPypmHardwareOutput(MidiBaseHardwareOutput):
 		try:
 			# If the output is already open, this crashes python,
 			# need to figure out why.
-			self.pm_output = pygame.pypm.Output(self.index,0)
+			self.pm_output = pygame.pypm.Output(self.index,self.latency)
 		except: 
 			raise Exception, "Unable to open "+self.name+" : "+format_exc()
 		if Midi.oneThread:
 			Midi.oneThread._add_midiout(self)
 
 	def is_open(self):
-		return (self.pm_output != None)
+		return (self.pm_output != None or self.remote)
+
+	def write_msg_at(self,msg,tm):
+		# tm is in Midi.time_now() seconds, PortMidi wants
+		# milliseconds on its own clock.  It sends at the timestamp
+		# plus the latency, so that's taken off.
+		if isinstance(Midi.clock,PortMidiClock):
+			self.timestamp = int(round(tm * 1000.0)) - self.latency
+		else:
+			dt = tm - Midi.time_now()
+			self.timestamp = pygame.pypm.Time() + int(round(dt * 1000.0)) \
+				- self.latency
+		try:
+			msg.write(self)
+		finally:
+			self.timestamp = None
 
 	def write_short(self,*bytes):
-		self.pm_output.WriteShort(*bytes)
+		if self.timestamp == None:
+			self.pm_output.WriteShort(*bytes)
+		else:
+			self.pm_output.Write([[list(bytes),self.timestamp]])
 
 	def write_sysex(self,bytes):
-		self.pm_output.WriteSysEx(0,bytes)
+		if isinstance(bytes,bytearray):
+			# pyPortMidi takes a list or a str
+			bytes = str(bytes)
+		if self.timestamp == None:
+			self.pm_output.WriteSysEx(0,bytes)
+		else:
+			self.pm_output.WriteSysEx(self.timestamp,bytes)
 
 	def close(self):
+		self.remote = False
 		del self.pm_output
 		self.pm_output = None
 		if Midi.oneThread:
@@ -193,8 +257,10 @@ class MidiPypmHardwareOutput(MidiBaseHardwareOutput):
 		# 	raise Exception,"Midi hasn't been started"
 		# if time == None:
 		# 	time = Midi.time_now()
-		Midi.schedule(self,msg,time)
+		return Midi.schedule(self,msg,time)
 
+	def schedule_many(self,msgs,time=None):
+		return Midi.schedule_many(self,msgs,time)
 
 	def __str__(self):
 		return 'MidiOutput(name="%s" index="%d")' % (self.name,self.index)
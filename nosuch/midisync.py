@@ -0,0 +1,171 @@
+"""
+This module generates MIDI clock (24 pulses per quarter note) and
+transport messages, so external gear can follow our tempo.
+"""
+
+import sys
+import time
+import traceback
+import thread
+
+from traceback import format_exc
+
+from nosuch.midiutil import *
+
+MIDI_CLOCK = 0xf8
+MIDI_START = 0xfa
+MIDI_CONTINUE = 0xfb
+MIDI_STOP = 0xfc
+
+class MidiClockGenerator:
+	"""
+	Sends clock pulses and start/stop/continue to an output, through
+	the MidiThread's high-priority lane.
+
+	Pulse n is due at origin + (n - origin_pulse) * period, where
+	origin is the time of the last start, continue or tempo change,
+	so rounding errors don't accumulate however long it runs.  Pulses
+	are scheduled up to ahead seconds before they're due, by a timer
+	callback.  Stopping (or changing tempo) cancels the ones that are
+	already scheduled past that point.
+	"""
+
+	ppqn = 24
+
+	def __init__(self,output,bpm=120.0,midithread=None,ahead=0.05):
+		self.output = output
+		self.midithread = midithread
+		self.ahead = ahead
+		self.period = 60.0 / (bpm * self.ppqn)
+		self.running = False
+		self.origin = 0.0
+		self.origin_pulse = 0
+		self.next_pulse = 0     # the next pulse to schedule
+		self.position = 0       # pulses sent before the last stop
+		self.pending = []       # (pulse,time,ScheduleHandle), in order
+		self.timer = None
+		self.lock = thread.allocate_lock()
+
+	def _thread(self):
+		if self.midithread:
+			return self.midithread
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread
+
+	def _now(self,tm):
+		if tm == None:
+			return self._thread().clock.time_now()
+		return tm
+
+	def bpm(self):
+		return 60.0 / (self.period * self.ppqn)
+
+	def pulse_time(self,n):
+		return self.origin + (n - self.origin_pulse) * self.period
+
+	def start(self,time=None):
+		"""
+		Send a start, and run the clock from the beginning.
+		"""
+		self._begin(MIDI_START,0,time)
+
+	def cont(self,time=None):
+		"""
+		Send a continue, and run the clock on from where it stopped.
+		"""
+		self._begin(MIDI_CONTINUE,self.position,time)
+
+	def stop(self,time=None):
+		"""
+		Send a stop, and stop sending pulses from time on.
+		"""
+		t = self._thread()
+		tm = self._now(time)
+		self.lock.acquire()
+		try:
+			if not self.running:
+				return
+			self.running = False
+			if self.timer:
+				self.timer.cancel()
+				self.timer = None
+			self.position = self._cut_at(tm)
+			t.schedule_realtime(self.output,RealTime(MIDI_STOP),tm)
+		finally:
+			self.lock.release()
+
+	def set_tempo(self,bpm,time=None):
+		"""
+		Change the tempo from the first pulse at or after time.
+		"""
+		tm = self._now(time)
+		self.lock.acquire()
+		try:
+			period = 60.0 / (bpm * self.ppqn)
+			if not self.running:
+				self.period = period
+				return
+			n = self._cut_at(tm)
+			# The pulse the change happens at keeps its time
+			self.origin = self.pulse_time(n)
+			self.origin_pulse = n
+			self.period = period
+			self._schedule_until(self._now(None) + self.ahead)
+		finally:
+			self.lock.release()
+
+	def _begin(self,status,pulse,time):
+		t = self._thread()
+		tm = self._now(time)
+		self.lock.acquire()
+		try:
+			if self.running:
+				return
+			self.running = True
+			self.origin = tm
+			self.origin_pulse = pulse
+			self.next_pulse = pulse
+			t.schedule_realtime(self.output,RealTime(status),tm)
+			self._schedule_until(tm + self.ahead)
+			self.timer = t.schedule_callback(self._tick,tm)
+		finally:
+			self.lock.release()
+
+	def _cut_at(self,tm):
+		# Make sure the pulses due before tm are scheduled, and
+		# cancel the ones due at or after it.  Returns the number of
+		# the first pulse that won't be sent.
+		self._schedule_until(tm)
+		pending = self.pending
+		while len(pending) > 0 and pending[-1][1] >= tm:
+			(n,ptm,h) = pending.pop()
+			h.cancel()
+			self.next_pulse = n
+		return self.next_pulse
+
+	def _schedule_until(self,until):
+		# Schedule the pulses due before until
+		t = self._thread()
+		while True:
+			n = self.next_pulse
+			tm = self.pulse_time(n)
+			if tm >= until:
+				break
+			h = t.schedule_realtime(self.output,RealTime(MIDI_CLOCK),tm)
+			self.pending.append((n,tm,h))
+			self.next_pulse = n + 1
+
+	def _tick(self,now,tm):
+		self.lock.acquire()
+		try:
+			if not self.running:
+				return None
+			# Forget the pulses that have been sent
+			pending = self.pending
+			while len(pending) > 0 and pending[0][1] < now:
+				pending.pop(0)
+			self._schedule_until(now + self.ahead)
+			return now + self.ahead / 2
+		finally:
+			self.lock.release()
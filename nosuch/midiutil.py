@@ -9,14 +9,20 @@ import thread
 import threading
 import copy
 import string
+import heapq
+import bisect
+import itertools
+import new
+import binascii
 import nosuch.midifile
 
 from threading import Thread,Lock
-from math import sqrt
+from math import sqrt,floor
 from ctypes import *
 from time import sleep
 from traceback import format_exc
 from array import array
+from collections import deque
 
 from nosuch.midifile import *
 
@@ -27,6 +33,78 @@ DEFAULT_PITCH = 64
 DEFAULT_VELOCITY = 64
 DEFAULT_DURATION = 1000
 
+# Bytes per second on a DIN MIDI cable, 31250 baud with 10 bits a byte
+MIDI_WIRE_RATE = 3125
+
+# Clocks give the time, in seconds, used for scheduling, timers
+# and input timestamps.
+
+class MidiClock:
+	"""
+	The wall clock, time.time().  It can jump (e.g. under NTP),
+	which disrupts scheduling, so MonotonicClock is the default.
+	"""
+
+	def time_now(self):
+		return time.time()
+
+class _timespec(Structure):
+	_fields_ = [("tv_sec",c_long),("tv_nsec",c_long)]
+
+def _monotonic_time_func():
+	# Python 2 has no time.monotonic, so find the nearest thing
+	if hasattr(time,"monotonic"):
+		return time.monotonic
+	if sys.platform == "win32":
+		# QueryPerformanceCounter, high-resolution and monotonic
+		return time.clock
+	try:
+		import ctypes.util
+		libname = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+		clock_gettime = CDLL(libname).clock_gettime
+		clock_gettime.argtypes = [c_int,POINTER(_timespec)]
+		if sys.platform == "darwin":
+			clock_id = 6
+		else:
+			clock_id = 1
+		def monotonic():
+			ts = _timespec()
+			clock_gettime(clock_id,byref(ts))
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+		monotonic()
+		return monotonic
+	except:
+		print "No monotonic clock available, using time.time()"
+		return time.time
+
+class MonotonicClock(MidiClock):
+	"""
+	A high-resolution clock that never jumps or goes backwards.
+	"""
+
+	def __init__(self):
+		self.time_now = _monotonic_time_func()
+
+class VirtualClock(MidiClock):
+	"""
+	A clock that only moves when it's told to, for deterministic
+	timing tests and offline rendering.
+	"""
+
+	def __init__(self,start=0.0):
+		self.now = float(start)
+
+	def time_now(self):
+		return self.now
+
+	def set(self,tm):
+		self.now = float(tm)
+		if Midi.oneThread:
+			Midi.oneThread._wake()
+
+	def advance(self,dt):
+		self.set(self.now + dt)
+
 class BaseEvent:
 	def __init__(self):
 		self.time = 0.0
@@ -71,6 +149,28 @@ class MidiEvent(BaseEvent):
 		# I suppose this should construct a bundle with a timetag
 		return self.midimsg.to_osc()
 		
+class RawMidiEvent(MidiEvent):
+	"""
+	A MidiEvent for a short message, holding its bytes.  The
+	midimsg is only made if it's asked for.
+	"""
+
+	def __init__(self,device,status,data1,data2,tm=0.0):
+		BaseEvent.__init__(self)
+		self.device = device
+		self.status = status
+		self.data1 = data1
+		self.data2 = data2
+		self.time = tm
+
+	def __getattr__(self,name):
+		if name == "midimsg":
+			m = midimsg_from_status(self.status,self.data1,self.data2)
+			m.device = self.device
+			self.midimsg = m
+			return m
+		raise AttributeError,name
+
 class TimerEvent(BaseEvent):
 	def __init__(self, tm, func, *args, **kwargs):
 		BaseEvent.__init__(self)
@@ -78,6 +178,12 @@ class TimerEvent(BaseEvent):
 		self.func = func
 		self.args = args
 		self.kwargs = kwargs
+		self.cancelled = False
+
+	def cancel(self):
+		# Remove the callback from the schedule, it's skipped
+		# (not searched for) when it comes due.
+		self.cancelled = True
 	
 	def invoke(self, tm):
 		result = self.func(tm, self.time, *self.args, **self.kwargs)
@@ -149,10 +255,12 @@ class MidiMsg:
 			b = int(attrs.get("value").nodeValue)
 			return RealTime(b)
 		if node.nodeName == "midi_sysex":
-			lng = int(attrs.get("length").nodeValue)
 			b = attrs.get("bytes").nodeValue
-			print("from_xml needs to implement midi_sysex")
-			return None
+			if b.startswith("0x"):
+				b = b[2:]
+			m = SysEx()
+			m.bytes = bytearray(binascii.unhexlify(b))
+			return m
 		raise Exception, "Unrecognized node in MidiMsg.from_xml: "+node.nodeName
 
 class ChanMsg(MidiMsg):
@@ -189,28 +297,40 @@ class RealTime(MidiMsg):
 		out.write_short(self.onebyte)
 
 class SysEx(MidiMsg):
+	"""
+	A SysEx message.  Its bytes, including the 0xf0 and EOX, are
+	kept in a bytearray.
+	"""
 
 	def __init__(self,b = None):
 		MidiMsg.__init__(self,"sysex")
 		if b == None:
-			self.bytes = []
+			self.bytes = bytearray()
 		else:
-			self.bytes = [b]
+			self.bytes = bytearray([b])
 
 	def append(self,b):
 		self.bytes.append(b)
 
+	def extend(self,bytes):
+		self.bytes.extend(bytes)
+
 	def __eq__(self,other):
 		if not isinstance(other,SysEx):
 			return False
-		print "Warning: __eq__ for SysEx needs implementing, always returns true"
-		return True
+		b = other.bytes
+		if not isinstance(b,bytearray):
+			b = bytearray(b)
+		return self.bytes == b
+
+	def __ne__(self,other):
+		return not self.__eq__(other)
 
 	def to_hex(self,c):
 		return "%02x" % c
 
 	def to_xml(self):
-		s = ''.join(map(self.to_hex,self.bytes))
+		s = binascii.hexlify(bytearray(self.bytes))
 		return '<%s length="%d" bytes="0x%s"/>' % (
 			self.common_xml(),len(self.bytes),s)
 
@@ -221,6 +341,19 @@ class SysEx(MidiMsg):
 	def write(self,out):
 		out.write_sysex(self.bytes)
 
+class SysExChunk(SysEx):
+	"""
+	Part of an incoming SysEx, when they're streamed (see the
+	MidiThread's sysex_chunk).  offset is where its bytes start in
+	the whole SysEx, so the first chunk has offset 0 and starts with
+	the 0xf0, and last is True for the final one.
+	"""
+
+	def __init__(self,b = None,offset=0):
+		SysEx.__init__(self,b)
+		self.offset = offset
+		self.last = False
+
 class NoteOn(ChanMsg):
 
 	def __init__(self,pitch,velocity=DEFAULT_VELOCITY,channel=DEFAULT_CHANNEL):
@@ -432,6 +565,10 @@ class ScheduledMidiMsg:
 		self.output = output
 		self.time = float(time)
 		self.msg = msg
+		self.cancelled = False
+		self.dispatched = False
+		# For the NoteOff of a SequencedNote, its NoteOn
+		self.noteon = None
 
 	def __str__(self):
 		if self.output == None:
@@ -439,6 +576,24 @@ class ScheduledMidiMsg:
 		else:
 			return "ScheduledMidiMsg(time=%f output=%s msg=%s)" % (self.time,self.output.name,str(self.msg))
 
+class ScheduleHandle:
+	"""
+	Returned by schedule(), used to cancel the scheduled messages
+	that haven't been sent yet.
+	"""
+
+	def __init__(self,midithread,msgs):
+		self.midithread = midithread
+		self.msgs = msgs
+
+	def cancel(self):
+		"""
+		Cancel the pending messages, returns the number cancelled.
+		The NoteOff of a SequencedNote whose NoteOn has already been
+		sent is not cancelled, so the note doesn't hang.
+		"""
+		return self.midithread._cancel(self.msgs)
+
 # Phrase things
 class PhraseMidiFileCallback:
 
@@ -488,6 +643,12 @@ class Phrase(list):
 	# def length(self):
 	# 	return len(self.events);
 
+	def schedule(self,output,time=None):
+		"""
+		Schedule the whole phrase on output, starting at time.
+		"""
+		Midi.schedule_many(output,self,time)
+
 	@staticmethod
 	def fromMidiFile(path):
 		p = Phrase()
@@ -554,9 +715,680 @@ class Note:
 			self.channel,self.pitch,self.velocity,self.duration)
 
 
+# Schedule queues hold ScheduledMidiMsgs in time order.
+# Messages with equal times come out in the order they were inserted.
+
+class MidiScheduleQueue:
+
+	def __init__(self):
+		pass
+
+	def __len__(self):
+		return 0
+
+	def push(self,m):
+		raise Exception,"MidiScheduleQueue.push needs implementing"
+
+	def push_many(self,msgs):
+		for m in msgs:
+			self.push(m)
+
+	def pop(self):
+		raise Exception,"MidiScheduleQueue.pop needs implementing"
+
+	def next_time(self):
+		# Returns None if the queue is empty
+		return None
+
+	def items(self):
+		# Returns a time-ordered list of the queued messages
+		return []
+
+class ListScheduleQueue(MidiScheduleQueue):
+	"""
+	The original sorted list, O(n) insert and dispatch.
+	"""
+
+	def __init__(self):
+		MidiScheduleQueue.__init__(self)
+		self.scheduled = []
+
+	def __len__(self):
+		return len(self.scheduled)
+
+	def push(self,m):
+		inserted = False
+		ix = 0
+		for i in self.scheduled:
+			if m.time < i.time:
+				inserted = True
+				self.scheduled.insert(ix,m)
+				break
+			ix = ix + 1
+		if not inserted:
+			self.scheduled.append(m)
+
+	def pop(self):
+		return self.scheduled.pop(0)
+
+	def next_time(self):
+		if len(self.scheduled) == 0:
+			return None
+		return self.scheduled[0].time
+
+	def items(self):
+		return list(self.scheduled)
+
+class HeapScheduleQueue(MidiScheduleQueue):
+	"""
+	A binary heap, O(log n) insert and dispatch.  A sequence number
+	in each entry keeps equal times in FIFO order.
+	"""
+
+	def __init__(self):
+		MidiScheduleQueue.__init__(self)
+		self.heap = []
+		self.seq = itertools.count()
+
+	def __len__(self):
+		return len(self.heap)
+
+	def push(self,m):
+		heapq.heappush(self.heap,(m.time,self.seq.next(),m))
+
+	def push_many(self,msgs):
+		# Rebuilding the heap is cheaper than pushing one at a
+		# time when adding more entries than it already holds.
+		if len(msgs) > len(self.heap):
+			seq = self.seq
+			self.heap.extend([(m.time,seq.next(),m) for m in msgs])
+			heapq.heapify(self.heap)
+		else:
+			for m in msgs:
+				heapq.heappush(self.heap,(m.time,self.seq.next(),m))
+
+	def pop(self):
+		return heapq.heappop(self.heap)[2]
+
+	def next_time(self):
+		if len(self.heap) == 0:
+			return None
+		return self.heap[0][0]
+
+	def items(self):
+		return [e[2] for e in sorted(self.heap)]
+
+class TimingWheelScheduleQueue(MidiScheduleQueue):
+	"""
+	A timing wheel of nslots slots, each slotsecs long, for events in
+	the next few seconds (most of which are note-offs), with a heap
+	for events beyond the end of the wheel.  Slots are plain lists
+	that are appended to, so insert is O(1) for events in the wheel.
+	When the cursor reaches a slot, the slot is sorted once and
+	becomes the current list, which is read in order.  An event
+	before the cursor moves the cursor back to it, if the wheel
+	still covers everything in it from there, otherwise (like one at
+	the cursor) it's inserted into the current list in place.
+
+	The slots are counted in blocks of 64, so the cursor can skip
+	empty blocks rather than stepping through each slot.
+
+	In pure Python the heap is still faster up to a few thousand
+	pending events, so it stays the default; the wheel only pays off
+	with very deep queues (around 10000 pending events and up).
+	"""
+
+	def __init__(self,slotsecs=0.001,nslots=4096):
+		MidiScheduleQueue.__init__(self)
+		if nslots % 64 != 0:
+			raise Exception,"TimingWheelScheduleQueue needs a multiple of 64 slots"
+		self.slotsecs = slotsecs
+		self.nslots = nslots
+		self.slots = [[] for i in range(nslots)]
+		self.blockcounts = [0] * (nslots / 64)
+		self.cursor = 0      # absolute tick of the current slot
+		self.current = []    # the sorted entries of the cursor's slot
+		self.pos = 0         # the next entry to read in current
+		self.nwheel = 0      # number of entries in the slots and current
+		self.maxtick = 0     # no slot entries are later than this
+		self.overflow = []
+		self.seq = itertools.count()
+
+	def __len__(self):
+		return self.nwheel + len(self.overflow)
+
+	def _tick(self,tm):
+		return int(floor(tm / self.slotsecs))
+
+	def push(self,m):
+		e = (m.time,self.seq.next(),m)
+		tick = int(floor(m.time / self.slotsecs))
+		if self.nwheel == 0 and len(self.overflow) == 0:
+			self.cursor = tick
+			self.current = []
+			self.pos = 0
+			self.maxtick = tick
+		cursor = self.cursor
+		current = self.current
+		pos = self.pos
+		if tick < cursor and self.maxtick < tick + self.nslots and \
+				(pos == len(current) or e < current[pos]):
+			# Put what's left of the current slot back into the
+			# slots for its times, and move the cursor to tick,
+			# taking in anything that's now in tick's slot.
+			slots = self.slots
+			blockcounts = self.blockcounts
+			n = self.nslots
+			for ce in current[pos:]:
+				i = self._tick(ce[0]) % n
+				slots[i].append(ce)
+				blockcounts[i >> 6] += 1
+			i = tick % n
+			current = slots[i]
+			slots[i] = []
+			blockcounts[i >> 6] -= len(current)
+			current.append(e)
+			current.sort()
+			self.cursor = tick
+			self.current = current
+			self.pos = 0
+			self.nwheel += 1
+		elif tick <= cursor:
+			if len(current) == pos or e >= current[-1]:
+				current.append(e)
+			else:
+				bisect.insort(current,e,pos)
+			self.nwheel += 1
+		elif tick < cursor + self.nslots:
+			i = tick % self.nslots
+			self.slots[i].append(e)
+			self.blockcounts[i >> 6] += 1
+			self.nwheel += 1
+			if tick > self.maxtick:
+				self.maxtick = tick
+		else:
+			heapq.heappush(self.overflow,e)
+
+	def _settle(self):
+		# current is used up, move the cursor to the next non-empty
+		# slot and make that current.
+		slots = self.slots
+		blockcounts = self.blockcounts
+		n = self.nslots
+		cursor = self.cursor
+		overflow = self.overflow
+		if self.nwheel > 0:
+			# Overflow events are all past the end of the wheel
+			# as it was, so they can't come before this slot.
+			cursor += 1
+			while True:
+				i = cursor % n
+				if len(slots[i]) > 0:
+					break
+				if blockcounts[i >> 6] == 0:
+					# On to the start of the next block
+					cursor += 64 - (i & 63)
+				else:
+					cursor += 1
+		elif len(overflow) > 0:
+			cursor = self._tick(overflow[0][0])
+		else:
+			self.current = []
+			self.pos = 0
+			return
+		self.cursor = cursor
+		# Pull in overflow events that the wheel now covers
+		end = cursor + n
+		while len(overflow) > 0:
+			tick = self._tick(overflow[0][0])
+			if tick >= end:
+				break
+			if tick < cursor:
+				tick = cursor
+			i = tick % n
+			slots[i].append(heapq.heappop(overflow))
+			blockcounts[i >> 6] += 1
+			self.nwheel += 1
+			if tick > self.maxtick:
+				self.maxtick = tick
+		i = cursor % n
+		current = slots[i]
+		slots[i] = []
+		blockcounts[i >> 6] -= len(current)
+		current.sort()
+		self.current = current
+		self.pos = 0
+
+	def pop(self):
+		if self.pos >= len(self.current):
+			self._settle()
+		current = self.current
+		pos = self.pos
+		e = current[pos]
+		pos += 1
+		if pos >= 1024 and pos * 2 > len(current):
+			# Late events keep arriving in the current slot,
+			# drop the ones already read.
+			del current[:pos]
+			pos = 0
+		self.pos = pos
+		self.nwheel -= 1
+		return e[2]
+
+	def next_time(self):
+		if self.pos >= len(self.current):
+			self._settle()
+			if len(self.current) == 0:
+				return None
+		return self.current[self.pos][0]
+
+	def items(self):
+		entries = list(self.overflow) + self.current[self.pos:]
+		for slot in self.slots:
+			entries.extend(slot)
+		return [e[2] for e in sorted(entries)]
+
+schedule_queue_types = {
+	"list": ListScheduleQueue,
+	"heap": HeapScheduleQueue,
+	"wheel": TimingWheelScheduleQueue,
+	}
+
+# Input decoding.  input_status_table has an entry for each status
+# byte, (builder,channel) for short messages and None otherwise.  The
+# builders make the message objects without going through their
+# constructors, since input data bytes are already in range.
+
+def _build_noteoff(ch,b1,b2):
+	return new.instance(NoteOff,{"name":"noteoff","channel":ch,
+		"pitch":b1,"velocity":b2})
+
+def _build_noteon(ch,b1,b2):
+	if b2 == 0:
+		return _build_noteoff(ch,b1,b2)
+	return new.instance(NoteOn,{"name":"noteon","channel":ch,
+		"pitch":b1,"velocity":b2})
+
+def _build_pressure(ch,b1,b2):
+	return new.instance(Pressure,{"name":"pressure","channel":ch,
+		"pitch":b1,"pressure":b2})
+
+def _build_controller(ch,b1,b2):
+	return new.instance(Controller,{"name":"controller","channel":ch,
+		"controller":b1,"value":b2})
+
+def _build_program(ch,b1,b2):
+	return new.instance(Program,{"name":"program","channel":ch,
+		"program":b1})
+
+def _build_channelpressure(ch,b1,b2):
+	return new.instance(ChannelPressure,{"name":"channelpressure",
+		"channel":ch,"pressure":b1})
+
+def _build_pitchbend(ch,b1,b2):
+	return new.instance(PitchBend,{"name":"pitchbend","channel":ch,
+		"value":(b1&0x3f)+((b2&0x3f)<<6)})
+
+def _build_realtime(b0,b1,b2):
+	return new.instance(RealTime,{"name":"realtime","onebyte":b0})
+
+def _make_input_status_table():
+	builders = {
+		0x80: _build_noteoff,
+		0x90: _build_noteon,
+		0xa0: _build_pressure,
+		0xb0: _build_controller,
+		0xc0: _build_program,
+		0xd0: _build_channelpressure,
+		0xe0: _build_pitchbend,
+		}
+	table = [None] * 256
+	for b0 in range(0x80,0xf0):
+		table[b0] = (builders[b0 & 0xf0],(b0 & 0x0f) + 1)
+	for b0 in range(0xf8,0x100):
+		table[b0] = (_build_realtime,b0)
+	return table
+
+input_status_table = _make_input_status_table()
+
+# The status byte (less the channel) for each type of channel message
+channel_msg_status = {
+	NoteOff: 0x80,
+	NoteOn: 0x90,
+	Pressure: 0xa0,
+	Controller: 0xb0,
+	Program: 0xc0,
+	ChannelPressure: 0xd0,
+	PitchBend: 0xe0,
+	}
+
+class MidiInputFilter:
+	"""
+	Says which input messages to discard, by their status byte, so
+	they're dropped before anything is made for them.  counts holds
+	the number discarded for each status byte.
+
+	@param realtime: True to discard all realtime messages, or a
+		sequence of the realtime bytes to discard (e.g. [0xf8,0xfe]
+		for timing clock and active sensing)
+	@param sysex: True to discard SysEx messages
+	@param channels: the channels (1-16) to discard messages on
+	@param types: the channel message classes (NoteOn, Controller,
+		etc.) to discard.  A NoteOn with velocity 0 counts as a
+		NoteOn here, not a NoteOff.
+	"""
+
+	def __init__(self,realtime=False,sysex=False,channels=(),types=()):
+		self.discard = [False] * 256
+		self.counts = [0] * 256
+		if realtime == True:
+			realtime = range(0xf8,0x100)
+		elif realtime == False:
+			realtime = []
+		for b in realtime:
+			self.discard[b] = True
+		if sysex:
+			self.discard[0xf0] = True
+		for ch in channels:
+			for hi in range(0x80,0xf0,0x10):
+				self.discard[hi + ch - 1] = True
+		for cls in types:
+			if not cls in channel_msg_status:
+				raise Exception,"MidiInputFilter can't filter %s" % cls
+			hi = channel_msg_status[cls]
+			for ch in range(16):
+				self.discard[hi + ch] = True
+
+	def nfiltered(self):
+		return sum(self.counts)
+
+	def reset(self):
+		self.counts = [0] * 256
+
+class MidiSubscription:
+	"""
+	Returned by MidiRouter.subscribe, cancel() unsubscribes.
+	"""
+
+	def __init__(self,router,func,data,device,statuses,low,high):
+		self.router = router
+		self.func = func
+		self.data = data
+		self.device = device
+		self.statuses = statuses
+		self.low = low
+		self.high = high
+
+	def cancel(self):
+		self.router.unsubscribe(self)
+
+class MidiRouter:
+	"""
+	Passes input events to the subscribers that want them.  For each
+	device it has a table, indexed by status byte, of the matching
+	subscribers, and for notes, polyphonic pressure and controllers,
+	a table of those indexed by the note or controller number.  The
+	tables are built when a device is first seen after the
+	subscriptions change, so dispatch is a couple of lookups.
+	"""
+
+	def __init__(self):
+		self.subscriptions = []
+		self.tables = {}
+
+	def __len__(self):
+		return len(self.subscriptions)
+
+	def subscribe(self,func,data=None,device=None,types=None,
+			channels=None,low=0,high=127):
+		"""
+		Call func(event,data) for input events matching all of:
+
+		@param device: the input device, or None for any
+		@param types: a sequence of message classes (NoteOn, Controller,
+			RealTime, SysEx, etc.), or None for any
+		@param channels: a sequence of channels (1-16), or None for
+			any.  Realtime and SysEx messages have no channel, and
+			are only matched when this is None.
+		@param low,high: the range of notes (for NoteOn, NoteOff and
+			Pressure) or controllers (for Controller) to match
+		@return: a MidiSubscription
+		"""
+		statuses = set()
+		if types == None:
+			types = channel_msg_status.keys() + [RealTime,SysEx]
+		for cls in types:
+			if cls in channel_msg_status:
+				if channels == None:
+					chans = range(1,17)
+				else:
+					chans = channels
+				for ch in chans:
+					statuses.add(channel_msg_status[cls] + ch - 1)
+			elif channels != None:
+				continue
+			elif cls == RealTime:
+				statuses.update(range(0xf8,0x100))
+			elif cls == SysEx:
+				statuses.add(0xf0)
+			else:
+				raise Exception,"MidiRouter can't subscribe to %s" % cls
+		sub = MidiSubscription(self,func,data,device,statuses,low,high)
+		# Readers may be using the old list and tables, so they
+		# are replaced rather than changed.
+		self.subscriptions = self.subscriptions + [sub]
+		self.tables = {}
+		return sub
+
+	def unsubscribe(self,sub):
+		self.subscriptions = [s for s in self.subscriptions if s is not sub]
+		self.tables = {}
+
+	def _build(self,device):
+		table = [None] * 256
+		subs = [s for s in self.subscriptions
+			if s.device == None or s.device is device]
+		for status in range(256):
+			matching = [s for s in subs if status in s.statuses]
+			if len(matching) == 0:
+				continue
+			if status < 0x80 or status >= 0xc0:
+				table[status] = tuple(matching)
+				continue
+			# Notes, pressure and controllers, by number
+			bynumber = []
+			last = None
+			for n in range(128):
+				t = tuple([s for s in matching if s.low <= n <= s.high])
+				if t != last:
+					last = t
+				bynumber.append(last)
+			table[status] = bynumber
+		return table
+
+	def dispatch(self,e,data=None):
+		"""
+		Pass MidiEvent e to the matching subscribers.  This has the
+		callback signature, so it can be given to Midi.callback.
+		"""
+		if isinstance(e,RawMidiEvent):
+			device = e.device
+			status = e.status
+			n = e.data1
+			if (status & 0xf0) == 0x90 and e.data2 == 0:
+				status -= 0x10
+		else:
+			m = e.midimsg
+			device = getattr(m,"device",None)
+			(status,n) = midimsg_status(m)
+		tables = self.tables
+		table = tables.get(device)
+		if table == None:
+			table = tables.setdefault(device,self._build(device))
+		subs = table[status]
+		if subs == None:
+			return
+		if isinstance(subs,list):
+			subs = subs[n]
+		for s in subs:
+			try:
+				s.func(e,s.data)
+			except:
+				print "Exception in midi subscriber: "+format_exc()
+
+def midimsg_status(m):
+	# Returns the status byte and note or controller number for m
+	if isinstance(m,RealTime):
+		return (m.onebyte,0)
+	if isinstance(m,SysEx):
+		return (0xf0,0)
+	status = channel_msg_status[m.__class__] + m.channel - 1
+	if isinstance(m,Controller):
+		return (status,m.controller)
+	return (status,getattr(m,"pitch",0))
+
+def midimsg_from_status(b0,b1,b2):
+	"""
+	Build the message for an input short message (or realtime)
+	from its bytes.  A NoteOn with velocity 0 becomes a NoteOff.
+	"""
+	entry = input_status_table[b0]
+	if entry == None:
+		raise Exception,"midimsg_from_status can't handle status byte %02x" % b0
+	return entry[0](entry[1],b1,b2)
+
+class MidiByteCollector:
+	"""
+	Stands in for an output device, to get the bytes of a message.
+	"""
+
+	def __init__(self):
+		self.bytes = []
+
+	def write_short(self,*bytes):
+		self.bytes.extend(bytes)
+
+	def write_sysex(self,bytes):
+		self.bytes.extend(bytes)
+
+def midimsg_bytes(msg):
+	c = MidiByteCollector()
+	msg.write(c)
+	return c.bytes
+
+def midimsg_length(msg):
+	# The number of bytes msg takes on the wire
+	if isinstance(msg,RealTime):
+		return 1
+	if isinstance(msg,(Program,ChannelPressure)):
+		return 2
+	if isinstance(msg,SysEx):
+		return len(msg.bytes)
+	return 3
+
+class MidiRunningStatusEncoder:
+	"""
+	Encodes messages for one byte-stream output, leaving out the
+	status byte when it's the same as the last one sent (running
+	status).  With noteoff_as_noteon, NoteOffs are sent as NoteOns
+	with velocity 0, so they continue runs of NoteOns.  nbytes and
+	nsaved count the bytes encoded and the bytes left out.
+	"""
+
+	def __init__(self,running=True,noteoff_as_noteon=False):
+		self.running = running
+		self.noteoff_as_noteon = noteoff_as_noteon
+		self.status = None
+		self.nbytes = 0
+		self.nsaved = 0
+
+	def reset(self):
+		# Send the next status byte whatever it is, e.g. after
+		# the output is reopened
+		self.status = None
+
+	def encode(self,msg):
+		bytes = midimsg_bytes(msg)
+		b0 = bytes[0]
+		if b0 >= 0xf8:
+			# Realtime bytes don't affect running status
+			pass
+		elif b0 >= 0xf0:
+			# System common and SysEx cancel it
+			self.status = None
+		else:
+			if self.noteoff_as_noteon and (b0 & 0xf0) == 0x80:
+				b0 = 0x90 | (b0 & 0x0f)
+				bytes = [b0,bytes[1],0]
+			if self.running and b0 == self.status:
+				bytes = bytes[1:]
+				self.nsaved += 1
+			else:
+				self.status = b0
+		self.nbytes += len(bytes)
+		return bytes
+
+class MidiWireModel:
+	"""
+	Paces the messages for one output to a byte rate, as set with
+	MidiThread.set_bandwidth.  Messages that arrive while the link
+	is still busy with earlier bytes wait in a queue, where note-offs
+	and realtime messages go ahead of everything else.  A note-off
+	doesn't go ahead of a waiting note-on for the same channel and
+	pitch, though, or the note would be left hanging.
+	"""
+
+	def __init__(self,rate=MIDI_WIRE_RATE):
+		self.rate = float(rate)
+		self.free_at = 0.0    # when the bytes already sent are done
+		self.queue = []
+		self.seq = itertools.count()
+		# (channel,pitch) of waiting note-ons, with their counts
+		self.noteons = {}
+
+	def priority(self,msg):
+		if isinstance(msg,RealTime):
+			return 0
+		if isinstance(msg,NoteOff) or \
+				(isinstance(msg,NoteOn) and msg.velocity == 0):
+			if self.noteons.get((msg.channel,msg.pitch),0) > 0:
+				return 1
+			return 0
+		return 1
+
+	def busy(self,now):
+		return self.free_at > now
+
+	def put(self,s):
+		m = s.msg
+		heapq.heappush(self.queue,
+			(self.priority(m),s.time,self.seq.next(),s))
+		if isinstance(m,NoteOn) and m.velocity > 0:
+			k = (m.channel,m.pitch)
+			self.noteons[k] = self.noteons.get(k,0) + 1
+
+	def pop(self):
+		s = heapq.heappop(self.queue)[3]
+		m = s.msg
+		if isinstance(m,NoteOn) and m.velocity > 0:
+			k = (m.channel,m.pitch)
+			n = self.noteons[k] - 1
+			if n == 0:
+				del self.noteons[k]
+			else:
+				self.noteons[k] = n
+		return s
+
+	def sent(self,msg,tm):
+		# Account for msg going out at tm
+		if self.free_at < tm:
+			self.free_at = tm
+		self.free_at += midimsg_length(msg) / self.rate
+
 class Midi:
 
 	oneThread = None
+	clock = MonotonicClock()
 	debug = False
 	device_index = 0
 	clocks_per_second = 192.0   # 96/quarter, 120 bpm
@@ -567,19 +1399,35 @@ class Midi:
 		return Midi.device_index
 
 	@staticmethod
-	def startup():
+	def startup(**kwargs):
 		# Perhaps we shouldn't really throw this exception,
 		# but it's probably good that people have only one place
 		# where it's started
 		if Midi.oneThread != None:
 			raise Exception,"Midi has already been started"
-		Midi.oneThread = MidiThread()
+		# kwargs are passed on to MidiThread, see there for the
+		# options, except clock which replaces Midi.clock,
+		# process (see nosuch.midiprocess) which runs the
+		# scheduler and devices in a separate process, and loop
+		# (see nosuch.midiloop) which runs them on an asyncio
+		# event loop instead of a thread.
+		if "clock" in kwargs:
+			Midi.clock = kwargs.pop("clock")
+		if kwargs.pop("process",False):
+			from nosuch.midiprocess import MidiProcessProxy
+			Midi.oneThread = MidiProcessProxy(**kwargs)
+		elif "loop" in kwargs:
+			from nosuch.midiloop import MidiLoopEngine
+			Midi.oneThread = MidiLoopEngine(**kwargs)
+		else:
+			Midi.oneThread = MidiThread(**kwargs)
 		Midi.oneThread.start()
 
 	@staticmethod
 	def shutdown():
 		if Midi.oneThread:
 			Midi.oneThread.keepgoing = False
+			Midi.oneThread._wake()
 
 	@staticmethod
 	def schedule(output,msg,time=None):
@@ -587,7 +1435,23 @@ class Midi:
 			raise Exception,"Midi hasn't been started"
 		if time == None:
 			time = Midi.time_now()
-		Midi.oneThread.schedule(output,msg,time)
+		return Midi.oneThread.schedule(output,msg,time)
+
+	@staticmethod
+	def schedule_many(output,msgs,time=None):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		if time == None:
+			time = Midi.time_now()
+		return Midi.oneThread.schedule_many(output,msgs,time)
+
+	@staticmethod
+	def schedule_realtime(output,msg,time=None):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		if time == None:
+			time = Midi.time_now()
+		return Midi.oneThread.schedule_realtime(output,msg,time)
 
 	@staticmethod
 	def num_scheduled():
@@ -597,7 +1461,61 @@ class Midi:
 
 	@staticmethod
 	def time_now():
-		return time.time()  # time in seconds
+		return Midi.clock.time_now()  # time in seconds
+
+	@staticmethod
+	def set_late_policy(policy,threshold=None,output=None):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		Midi.oneThread.set_late_policy(policy,threshold,output)
+
+	@staticmethod
+	def set_bandwidth(rate,output):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		Midi.oneThread.set_bandwidth(rate,output)
+
+	@staticmethod
+	def set_running_status(output,running=True,noteoff_as_noteon=False):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		Midi.oneThread.set_running_status(output,running,noteoff_as_noteon)
+
+	@staticmethod
+	def input_counters():
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.get_input_counters()
+
+	@staticmethod
+	def counters(output=None):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.get_counters(output)
+
+	@staticmethod
+	def reset_counters():
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		Midi.oneThread.reset_counters()
+
+	@staticmethod
+	def stats():
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.get_stats()
+
+	@staticmethod
+	def reset_stats():
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		Midi.oneThread.reset_stats()
+
+	@staticmethod
+	def schedule_callback(func,time=None,*args,**kwargs):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.schedule_callback(func,time,*args,**kwargs)
 
 	@staticmethod
 	def callback(f,data):
@@ -605,6 +1523,26 @@ class Midi:
 			raise Exception,"Midi hasn't been started"
 		return Midi.oneThread.callback(f,data)
 
+	@staticmethod
+	def subscribe(func,data=None,device=None,types=None,channels=None,
+			low=0,high=127):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.subscribe(func,data,device,types,channels,
+			low,high)
+
+	@staticmethod
+	def rawcallback(f,data):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.rawcallback(f,data)
+
+	@staticmethod
+	def batchcallback(f,data):
+		if not Midi.oneThread:
+			raise Exception,"Midi hasn't been started"
+		return Midi.oneThread.batchcallback(f,data)
+
 	@staticmethod
 	def bound_value(v):
 		if v < 0:
@@ -615,13 +1553,36 @@ class Midi:
 
 class MidiThread(Thread):
 
-	def __init__(self):
+	def __init__(self,scheduler="heap",wakeup="poll",submit="lock",
+			output_workers=False,lookahead=0.0,clock=None,input_batch=64,
+			input_delivery="direct",input_queue_size=1000,
+			sysex_max=1048576,sysex_chunk=None):
 		Thread.__init__(self)
-		self.too_old_clockssecs = 1000 * 30   # 30 seconds
+		if not scheduler in schedule_queue_types:
+			raise Exception,"Unknown scheduler type: %s" % scheduler
+		if not wakeup in ("poll","event"):
+			raise Exception,"Unknown wakeup mode: %s" % wakeup
+		if not submit in ("lock","queue"):
+			raise Exception,"Unknown submit mode: %s" % submit
+		if isinstance(input_delivery,str) and \
+				not input_delivery in ("direct","thread"):
+			raise Exception,"Unknown input delivery: %s" % input_delivery
+
+		if clock == None:
+			clock = Midi.clock
+		self.clock = clock
 
 		self.midiinout_lock = thread.allocate_lock()
 		self.scheduled_lock = thread.allocate_lock()
 		self.midiin = {}
+		# Inputs are read up to input_batch events at a time (PortMidi
+		# allows up to 1024), until they're drained on each pass.
+		self.input_batch = input_batch
+		# Incoming SysEx longer than sysex_max bytes is dropped.  With
+		# sysex_chunk, SysEx is passed on in SysExChunks of about that
+		# many bytes as it arrives instead, and there's no maximum.
+		self.sysex_max = sysex_max
+		self.sysex_chunk = sysex_chunk
 		self.midiin_add = None
 		self.midiin_del = None
 		self.midiout_add = None
@@ -632,27 +1593,157 @@ class MidiThread(Thread):
 		self.nextevent = 0
 		self.keepgoing = True
 		# self.clocks_per_second = 192.0   # 96/quarter, 120 bpm
-		self.timenow = Midi.time_now()
-		self.scheduled = []
+		self.timenow = self.clock.time_now()
+		self.scheduled = schedule_queue_types[scheduler]()
 		self.next_scheduled = None
+		# The high-priority lane, for realtime messages such as
+		# clock pulses, see schedule_realtime.
+		self.realtime_lane = HeapScheduleQueue()
+		self.next_realtime = None
+		self.ncancelled = 0   # cancelled but still in the schedule or held
 		self.callback_func = None
 		self.callback_data = None
+		self.rawcallback_func = None
+		self.rawcallback_data = None
+		# See batchcallback; input_batched collects a pass's events
+		self.batchcallback_func = None
+		self.batchcallback_data = None
+		self.input_batched = []
+		# Input subscriptions, see subscribe
+		self.router = MidiRouter()
 		self.outputcallback_func = None
 		self.outputcallback_data = None
+
+		# With input_delivery "direct" the input callback is called
+		# on this thread.  With "thread" input events go through a
+		# queue of up to input_queue_size events to a MidiCallbackWorker
+		# thread, and otherwise input_delivery is an executor (anything
+		# with a submit(func,*args) method) that may have up to
+		# input_queue_size events outstanding.  Events that don't fit
+		# are dropped, and counted in input_counters.
+		self.input_delivery = input_delivery
+		self.input_queue_size = input_queue_size
+		self.callback_worker = None
+		self.executor_pending = 0
+		self.executor_lock = thread.allocate_lock()
+		self.input_counters = {}
+		# Set in MidiProcessProxy, where devices live in another process
+		self.remote = False
 		
 		self._timer_calls = []
 		self._next_timer = None
+		self._timer_seq = itertools.count()
+		self.timer_lock = thread.allocate_lock()
+
+		# The late policy is (policy,threshold-in-seconds), see
+		# set_late_policy.  late_policies holds per-output ones.
+		self.late_policy = ("send",0.1)
+		self.late_policies = {}
+		self.counters = {}
+		self.histograms = {}
+		# For timestamped outputs, how far ahead of their time
+		# messages were handed over, see get_stats
+		self.lead_histograms = {}
+		# Outputs' names in get_stats, made unique
+		self.stats_names = {}
+		self.stats_lock = thread.allocate_lock()
+
+		# Running status encoders for outputs that take raw bytes
+		# (have a write_bytes method), see set_running_status.
+		self.encoders = {}
+
+		# Outputs paced to a byte rate, see set_bandwidth.  npaced
+		# is the number of messages waiting in their queues.
+		self.wires = {}
+		self.npaced = 0
+		# (output,rate) changes for this thread to make
+		self.wire_changes = deque()
+
+		# In "poll" mode the loop sleeps for poll_interval each time.
+		# In "event" mode it sleeps until the next scheduled or timer
+		# deadline (polling inputs every poll_interval if any are open),
+		# and is woken early when an earlier deadline arrives.
+		# max_sleep bounds the sleep, since the Python 2 Event.wait
+		# is itself a polling loop whose reaction to set() slows as
+		# the wait gets longer.
+		self.wakeup = wakeup
+		self.poll_interval = 0.001
+		self.max_sleep = 0.01
+		self.wakeup_event = threading.Event()
+		self.sleep_until = None
+
+		# In "lock" mode, schedule() inserts into the schedule directly,
+		# taking scheduled_lock.  In "queue" mode it appends to the
+		# submitted deque (append and popleft are atomic, so producers
+		# never block) and the loop drains it into the schedule.
+		self.submit = submit
+		self.submitted = deque()
+
+		# If output_workers is set, each output registered with
+		# _add_midiout gets its own MidiOutputWorker thread to write
+		# to it, so a device that blocks doesn't hold up the others.
+		self.output_workers = output_workers
+		self.workers = {}
+
+		# Outputs with timestamped set (e.g. a PortMidi output opened
+		# with a latency) are given their messages up to lookahead
+		# seconds early, along with the time they should go out, and
+		# do their own precise timing.  Messages for other outputs
+		# that come off the schedule early wait in held.  Adding an
+		# output with a latency (in milliseconds) raises lookahead to
+		# at least that, until the output is removed.
+		self.lookahead = lookahead
+		self.base_lookahead = lookahead
+		self.output_lookaheads = {}
+		self.held = []
+		self.heldseq = itertools.count()
 
 	def num_scheduled(self):
 		self.scheduled_lock.acquire()
-		n = len(self.scheduled)
+		n = len(self.scheduled) + len(self.realtime_lane) - self.ncancelled
 		self.scheduled_lock.release()
+		n += len(self.held) + self.npaced
+		for b in list(self.submitted):
+			n += len(b)
 		return n
 
 	def callback(self,f,data):
 		self.callback_func = f
 		self.callback_data = data
 
+	def subscribe(self,func,data=None,device=None,types=None,
+			channels=None,low=0,high=127):
+		"""
+		Subscribe to input events, alongside the callback and other
+		subscribers; see MidiRouter.subscribe.  Subscribers are
+		called wherever the callback would be (see input_delivery).
+		"""
+		return self.router.subscribe(func,data,device,types,channels,
+			low,high)
+
+	def rawcallback(self,f,data):
+		"""
+		Set a callback for the fast input path.  For each short
+		message (or realtime byte) it's called on this thread with a
+		(time,device,status,data1,data2) tuple, before any message
+		object is made.  If there's no other callback, none is ever
+		made.  SysEx only goes to the regular callback.
+		"""
+		self.rawcallback_func = f
+		self.rawcallback_data = data
+
+	def batchcallback(self,f,data):
+		"""
+		Set a callback that's called once per pass of the loop, with
+		the list of MidiEvents decoded in that pass (in time order),
+		instead of once per event.  It's delivered the same way as
+		the callback (see input_delivery), where a whole list takes
+		one place in the queue.  The callback and subscribers still
+		get each event too, if they're set.
+		"""
+		self.batchcallback_func = f
+		self.batchcallback_data = data
+
 	def outputcallback(self,f,data):
 		self.outputcallback_func = f
 		self.outputcallback_data = data
@@ -660,87 +1751,176 @@ class MidiThread(Thread):
 	def run(self):
 		try:
 			while self.keepgoing:
-				self.timenow = Midi.time_now()
+				self.timenow = self.clock.time_now()
 				# print "LOOP self.timenow updated to %f" % self.timenow
-				if self.next_scheduled <= self.timenow:
+				self._poll_sources()
+				if self._is_due(self.timenow):
 					self._send_scheduled(self.timenow)
 
-				# make sure midiin doesn't change during loop
-				self.midiinout_lock.acquire()
-				if self.midiin_add:
-					for i in self.midiin_add:
-						self.midiin[i] = self.midiin_add[i]
-					self.midiin_add = None
-
-				if self.midiin_del:
-					for i in self.midiin_del:
-						del self.midiin[i]
-					self.midiin_del = None
-
-				if self.midiout_add:
-					for i in self.midiout_add:
-						self.thread_midiout[i] = self.midiout_add[i]
-					self.midiout_add = None
-
-				if self.midiout_del:
-					for i in self.midiout_del:
-						del self.thread_midiout[i]
-					self.midiout_del = None
-				self.midiinout_lock.release()
+				self._update_devices()
 
 				if self._next_timer <= self.timenow:
 					self._invoke_timer_callbacks(self.timenow)
 
-				for k in self.midiin:
-					v = self.midiin[k]
-					if not v:
-						continue
-					if not v.is_open():
-						continue
-					if v.poll():
-						try:
-							d = v.read(1)
-						except:
-							print "EXCEPTION while reading MIDI Input = %s" % format_exc()
-						if d != None:
-							bytes = d[0][0]
-							tm = d[0][1]
-							self._gotmidi(v,bytes,tm)
-				sleep(0.001)
-
-			if Midi.debug:
-				print "Closing MIDI inputs..."
-			for k in self.midiin:
-				v = self.midiin[k]
-				if v:
-					try:
-						v.close()
-					except:
-						print "Exception in v.close_input: %s"  % format_exc()
-						pass
-					self.midiin[k] = None
-			if Midi.debug:
-				print "Closing MIDI outputs..."
-			for k in self.thread_midiout:
-				v = self.thread_midiout[k]
-				if v:
-					try:
-						v.close()
-					except:
-						print "Exception in v.close_output: %s"  % format_exc()
-						pass
-					self.midiin[k] = None
+				self._read_inputs()
+				self._sleep()
+			self._close_devices()
+			self._stop_callback_worker()
 			return
 
 		except:
 			print "EXCEPTION in MidiThread.run()!? = %s" % format_exc()
 
+	def _update_devices(self):
+		# make sure midiin doesn't change during loop
+		self.midiinout_lock.acquire()
+		if self.midiin_add:
+			for i in self.midiin_add:
+				self.midiin[i] = self.midiin_add[i]
+			self.midiin_add = None
+
+		if self.midiin_del:
+			for i in self.midiin_del:
+				del self.midiin[i]
+			self.midiin_del = None
+
+		if self.midiout_add:
+			for i in self.midiout_add:
+				self.thread_midiout[i] = self.midiout_add[i]
+				if self.output_workers:
+					self._start_worker(i)
+			self.midiout_add = None
+
+		if self.midiout_del:
+			for i in self.midiout_del:
+				del self.thread_midiout[i]
+				self._stop_worker(i)
+			self.midiout_del = None
+		self.midiinout_lock.release()
+
+	def _read_inputs(self):
+		for k in self.midiin:
+			v = self.midiin[k]
+			if not v:
+				continue
+			if not v.is_open():
+				continue
+			while v.poll():
+				try:
+					d = v.read(self.input_batch)
+				except:
+					print "EXCEPTION while reading MIDI Input = %s" % format_exc()
+					break
+				if not d:
+					break
+				# Each event is [[status,data1,data2,data3],timestamp]
+				for (bytes,tm) in d:
+					self._gotmidi(v,bytes,tm)
+				if len(d) < self.input_batch:
+					break
+		if len(self.input_batched) > 0:
+			self._flush_input_batch()
+
+	def _close_devices(self):
+		if Midi.debug:
+			print "Closing MIDI inputs..."
+		for k in self.midiin:
+			v = self.midiin[k]
+			if v:
+				try:
+					v.close()
+				except:
+					print "Exception in v.close_input: %s"  % format_exc()
+					pass
+				self.midiin[k] = None
+		if Midi.debug:
+			print "Closing MIDI outputs..."
+		for k in self.workers.keys():
+			self._stop_worker(k)
+		for k in self.thread_midiout:
+			v = self.thread_midiout[k]
+			if v:
+				try:
+					v.close()
+				except:
+					print "Exception in v.close_output: %s"  % format_exc()
+					pass
+				self.midiin[k] = None
+
+	def _sleep(self):
+		if self.wakeup != "event":
+			sleep(self.poll_interval)
+			return
+		self.wakeup_event.clear()
+		now = self.clock.time_now()
+		# Set sleep_until before looking at the deadlines, so that
+		# anything scheduled after this point will wake us.
+		self.sleep_until = now + self.max_sleep
+		# Anything submitted since _poll_sources looked, before
+		# sleep_until was set, didn't wake us, so don't sleep.
+		if self.submitted or self.wire_changes:
+			self.sleep_until = None
+			return
+		deadline = self._next_deadline()
+		dt = self.max_sleep
+		if deadline != None and (deadline - now) < dt:
+			dt = deadline - now
+		if len(self.midiin) > 0 and self.poll_interval < dt:
+			dt = self.poll_interval
+		if dt <= 0.0:
+			self.sleep_until = None
+			return
+		self.sleep_until = now + dt
+		self.wakeup_event.wait(dt)
+		self.sleep_until = None
+
+	def _is_due(self,now):
+		# Whether _send_scheduled has anything to do
+		if self.next_scheduled <= (now + self.lookahead):
+			return True
+		if self.next_realtime != None and self.next_realtime <= now:
+			return True
+		return len(self.held) > 0 or self.npaced > 0
+
+	def _next_deadline(self):
+		# Earliest of the next scheduled, realtime, held and timer
+		# deadlines
+		deadline = self.next_scheduled
+		if deadline != None:
+			deadline -= self.lookahead
+		if self.next_realtime != None:
+			if deadline == None or self.next_realtime < deadline:
+				deadline = self.next_realtime
+		if len(self.held) > 0:
+			if deadline == None or self.held[0][0] < deadline:
+				deadline = self.held[0][0]
+		if self._next_timer != None:
+			if deadline == None or self._next_timer < deadline:
+				deadline = self._next_timer
+		if self.npaced > 0:
+			for w in self.wires.values():
+				if len(w.queue) > 0:
+					if deadline == None or w.free_at < deadline:
+						deadline = w.free_at
+		return deadline
+
+	def _wake(self,tm=None):
+		# Wake the thread if it's sleeping past tm (or at all, if tm is None)
+		if self.wakeup != "event":
+			return
+		until = self.sleep_until
+		if until == None:
+			return
+		if tm == None or (tm - self.lookahead) < until:
+			self.wakeup_event.set()
+
 	def _add_midiin(self,mi):
 		self.midiinout_lock.acquire()
 		if self.midiin_add == None:
 			self.midiin_add = {}
 		self.midiin_add[mi] = mi  # NEW CODE
 		self.midiinout_lock.release()
+		self._wake()
 
 	def _remove_midiin(self,m):
 		self.midiinout_lock.acquire()
@@ -750,6 +1930,13 @@ class MidiThread(Thread):
 		self.midiinout_lock.release()
 
 	def _add_midiout(self,mi):
+		if getattr(mi,"timestamped",False):
+			# Messages have to be handed over at least latency
+			# early, or PortMidi sends them late.
+			ahead = getattr(mi,"latency",0) / 1000.0
+			self.output_lookaheads[mi] = ahead
+			if ahead > self.lookahead:
+				self.lookahead = ahead
 		self.midiinout_lock.acquire()
 		if self.midiout_add == None:
 			self.midiout_add = {}
@@ -757,6 +1944,10 @@ class MidiThread(Thread):
 		self.midiinout_lock.release()
 
 	def _remove_midiout(self,m):
+		if m in self.output_lookaheads:
+			del self.output_lookaheads[m]
+			self.lookahead = max([self.base_lookahead] +
+				self.output_lookaheads.values())
 		self.midiinout_lock.acquire()
 		if self.midiout_del == None:
 			self.midiout_del = {}
@@ -765,61 +1956,385 @@ class MidiThread(Thread):
 
 	def _send_scheduled(self,now):
 
+		# The realtime lane goes first, and isn't subject to the
+		# late policies, since dropping clock pulses would upset
+		# the tempo.
+		while self.next_realtime != None and self.next_realtime <= now:
+			self.scheduled_lock.acquire()
+			s = self.realtime_lane.pop()
+			self.next_realtime = self.realtime_lane.next_time()
+			if s.cancelled:
+				self.ncancelled -= 1
+				self.scheduled_lock.release()
+				continue
+			s.dispatched = True
+			self.scheduled_lock.release()
+			self._dispatch(s,now)
+
+		# Messages waiting for a paced output's link to be free
+		if self.npaced > 0:
+			self._send_paced(now)
+
+		# Messages held back from a previous lookahead
+		held = self.held
+		while len(held) > 0 and held[0][0] <= now:
+			s = heapq.heappop(held)[2]
+			# They can still be cancelled until now
+			self.scheduled_lock.acquire()
+			if s.cancelled:
+				self.ncancelled -= 1
+				self.scheduled_lock.release()
+				continue
+			s.dispatched = True
+			self.scheduled_lock.release()
+			if self._is_dropped_late(s,now):
+				continue
+			self._dispatch(s,now)
+
+		ahead = now + self.lookahead
 		while True:
 
 			self.scheduled_lock.acquire()
-			if self.next_scheduled == None or self.next_scheduled > now:
+			if self.next_scheduled == None or self.next_scheduled > ahead:
 				self.scheduled_lock.release()
 				break
-			s = self.scheduled.pop(0)
+			s = self.scheduled.pop()
+			self.next_scheduled = self.scheduled.next_time()
+			# Cancelled messages are left in the schedule and
+			# skipped here.  dispatched is set under the lock,
+			# so _cancel sees a consistent value.
+			if s.cancelled:
+				self.ncancelled -= 1
+				self.scheduled_lock.release()
+				continue
+			if s.time > now and not getattr(s.output,"timestamped",False):
+				self.scheduled_lock.release()
+				heapq.heappush(held,(s.time,self.heldseq.next(),s))
+				continue
+			s.dispatched = True
 			self.scheduled_lock.release()
 
-			if not s.output.is_open():
-				print "Scheduled output device isn't open?"
-			else:
+			if self._is_dropped_late(s,now):
+				continue
+			self._dispatch(s,now)
+
+	def _dispatch(self,s,now):
+		if len(self.wires) > 0:
+			wire = self.wires.get(s.output)
+			if wire:
+				self._pace(wire,s,now)
+				return
+		self._dispatch_now(s,now)
+
+	def _dispatch_now(self,s,now):
+		w = self.workers.get(s.output)
+		if w:
+			w.put(s,now)
+		else:
+			self._write_scheduled(s,now)
+
+	def _pace(self,wire,s,now):
+		if getattr(s.output,"timestamped",False):
+			# The output does its own timing, so move the
+			# timestamp back to when the link will be free.
+			if wire.busy(s.time):
+				self._counters_for(s.output)["deferred"] += 1
+				s.time = wire.free_at
+			wire.sent(s.msg,s.time)
+			self._dispatch_now(s,now)
+		elif len(wire.queue) == 0 and not wire.busy(now):
+			wire.sent(s.msg,now)
+			self._dispatch_now(s,now)
+		else:
+			self._counters_for(s.output)["deferred"] += 1
+			wire.put(s)
+			self.npaced += 1
+
+	def _send_paced(self,now):
+		for wire in self.wires.values():
+			while len(wire.queue) > 0 and not wire.busy(now):
+				s = wire.pop()
+				self.npaced -= 1
+				wire.sent(s.msg,now)
+				self._dispatch_now(s,now)
+
+	def _start_worker(self,output):
+		if output in self.workers:
+			return
+		w = MidiOutputWorker(self,output)
+		self.workers[output] = w
+		w.start()
+
+	def _stop_worker(self,output):
+		w = self.workers.pop(output,None)
+		if w:
+			w.stop()
+			w.join()
+
+	def _cancel(self,msgs):
+		n = 0
+		self.scheduled_lock.acquire()
+		for m in msgs:
+			if m.cancelled or m.dispatched:
+				continue
+			if m.noteon != None and m.noteon.dispatched:
+				continue
+			m.cancelled = True
+			n += 1
+		self.ncancelled += n
+		self.scheduled_lock.release()
+		return n
+
+	def _is_dropped_late(self,s,now):
+		# Apply the output's late policy, returns True if s should
+		# not be sent.
+		(policy,threshold) = self.late_policies.get(s.output,self.late_policy)
+		if (now - s.time) <= threshold:
+			return False
+		c = self._counters_for(s.output)
+		c["late"] += 1
+		if policy == "send":
+			return False
+		if policy == "drop_noteons" and not isinstance(s.msg,NoteOn):
+			return False
+		c["dropped"] += 1
+		if Midi.debug:
+			print "Dropping late:",s.msg," now=",now," s.time=",s.time
+		return True
+
+	def _write_scheduled(self,s,now):
+		if s.cancelled:
+			return
+		if not s.output.is_open():
+			print "Scheduled output device isn't open?"
+			return
+		try:
+			if Midi.debug:
+				print "Writing:",s.msg,"to",s.output.name," now=",now," s.time=",s.time
+			# If output callback is set, use it,
+			# otherwise write to portmidi output.
+			if self.outputcallback_func:
 				try:
-					if Midi.debug:
-						print "Writing:",s.msg,"to",s.output.name," now=",now," s.time=",s.time
-					# If output callback is set, use it,
-					# otherwise write to portmidi output.
-					if self.outputcallback_func:
-						try:
-							self.outputcallback_func(s,self.outputcallback_data)
-						except:
-							print "Exception in midi output callback: "+format_exc()
-					else:
-						if hasattr(s.output,"write_msg"):
-							s.output.write_msg(s.msg)
-						else:
-							s.msg.write(s.output)
+					self.outputcallback_func(s,self.outputcallback_data)
 				except:
-					# print "out=",s.msg
-					print "Error writing MIDI output: %s" % sys.exc_info()[1]
-			self.scheduled_lock.acquire()
-			if len(self.scheduled) == 0:
-				self.next_scheduled = None
-				self.scheduled_lock.release()
-				return
-			self.next_scheduled = self.scheduled[0].time
-			self.scheduled_lock.release()
+					print "Exception in midi output callback: "+format_exc()
+			else:
+				if getattr(s.output,"timestamped",False):
+					s.output.write_msg_at(s.msg,s.time)
+				elif hasattr(s.output,"write_bytes"):
+					e = self.encoders.get(s.output)
+					if e == None:
+						e = self.encoders.setdefault(s.output,
+							MidiRunningStatusEncoder())
+					s.output.write_bytes(e.encode(s.msg))
+				elif hasattr(s.output,"write_msg"):
+					s.output.write_msg(s.msg)
+				else:
+					s.msg.write(s.output)
+			self._counters_for(s.output)["sent"] += 1
+			if getattr(s.output,"timestamped",False):
+				# PortMidi does the sending, we only know when
+				# we handed it over
+				h = self.lead_histograms.get(s.output)
+				if h == None:
+					h = self.lead_histograms.setdefault(s.output,
+						LatenessHistogram())
+				h.record(s.time - self.clock.time_now())
+			else:
+				h = self.histograms.get(s.output)
+				if h == None:
+					h = self.histograms.setdefault(s.output,
+						LatenessHistogram())
+				h.record(self.clock.time_now() - s.time)
+		except:
+			# print "out=",s.msg
+			print "Error writing MIDI output: %s" % sys.exc_info()[1]
+
+	def _counters_for(self,output):
+		c = self.counters.get(output)
+		if c == None:
+			# setdefault, since output workers may get here too
+			c = self.counters.setdefault(output,
+				{"sent":0, "late":0, "dropped":0, "deferred":0})
+			self._stats_name(output)
+		return c
+
+	def _stats_name(self,output):
+		# Outputs with the same name get "#2", "#3"... added, in
+		# the order they're first used
+		self.stats_lock.acquire()
+		try:
+			name = self.stats_names.get(output)
+			if name == None:
+				base = getattr(output,"name",str(output))
+				used = set(self.stats_names.values())
+				name = base
+				n = 2
+				while name in used:
+					name = "%s#%d" % (base,n)
+					n += 1
+				self.stats_names[output] = name
+			return name
+		finally:
+			self.stats_lock.release()
+
+	def get_counters(self,output=None):
+		"""
+		Returns a copy of the sent/late/dropped/deferred counters for output,
+		or the totals over all outputs if output is None.
+		"""
+		if output != None:
+			return dict(self._counters_for(output))
+		total = {"sent":0, "late":0, "dropped":0, "deferred":0}
+		for c in self.counters.values():
+			for k in total:
+				total[k] += c[k]
+		return total
+
+	def reset_counters(self):
+		self.counters = {}
+
+	def get_stats(self):
+		"""
+		Returns a dictionary, keyed by output name, of the dispatch
+		lateness summary (count, mean, p50, p90, p99 and max, in
+		seconds) merged with the sent/late/dropped counters.  Outputs
+		that share a name have "#2", "#3"... added to it.
+
+		Timestamped outputs are sent by PortMidi, so there's no
+		lateness for them (count is 0).  Instead "lead" is the
+		same summary of how far ahead of its time each message was
+		handed over, where 0 means it was handed over late.
+		"""
+		stats = {}
+		outputs = set(self.counters.keys()) | set(self.histograms.keys()) \
+			| set(self.lead_histograms.keys())
+		for output in outputs:
+			h = self.histograms.get(output)
+			if h == None:
+				st = {"count":0}
+			else:
+				st = h.summary()
+			h = self.lead_histograms.get(output)
+			if h != None:
+				st["lead"] = h.summary()
+			st.update(self._counters_for(output))
+			stats[self._stats_name(output)] = st
+		return stats
+
+	def reset_stats(self):
+		self.histograms = {}
+		self.lead_histograms = {}
+		self.counters = {}
+
+	def set_late_policy(self,policy,threshold=None,output=None):
+		"""
+		Set what happens to events that are dispatched more than
+		threshold seconds after their scheduled time.
+
+		@param policy: "send" sends them anyway, "drop" drops them,
+			and "drop_noteons" drops NoteOns but still sends
+			everything else, so notes already sounding get turned off.
+		@param threshold: lateness in seconds, or None to keep the
+			current threshold
+		@param output: the output to set the policy for, or None to
+			set the default for outputs without their own policy
+		"""
+		if not policy in ("send","drop","drop_noteons"):
+			raise Exception,"Unknown late policy: %s" % policy
+		if output == None:
+			if threshold == None:
+				threshold = self.late_policy[1]
+			self.late_policy = (policy,threshold)
+		else:
+			if threshold == None:
+				threshold = self.late_policies.get(output,self.late_policy)[1]
+			self.late_policies[output] = (policy,threshold)
+
+	def set_bandwidth(self,rate,output):
+		"""
+		Pace the writes to output to rate bytes per second (e.g.
+		MIDI_WIRE_RATE for a DIN cable), or stop pacing it if rate is
+		None.  When the link is saturated, note-offs and realtime
+		messages go before other waiting messages, and the messages
+		that have to wait are counted as "deferred".
+		"""
+		# This thread makes the change, since anything waiting has
+		# to be written out.
+		self.wire_changes.append((output,rate))
+		self._wake()
+
+	def _change_wires(self):
+		while len(self.wire_changes) > 0:
+			(output,rate) = self.wire_changes.popleft()
+			wire = self.wires.pop(output,None)
+			if wire:
+				# Anything still waiting goes out now
+				while len(wire.queue) > 0:
+					self.npaced -= 1
+					self._dispatch_now(wire.pop(),self.timenow)
+			if rate != None:
+				self.wires[output] = MidiWireModel(rate)
+
+	def set_running_status(self,output,running=True,noteoff_as_noteon=False):
+		"""
+		Set how messages are encoded for an output that takes raw
+		bytes (one with a write_bytes method).  Such outputs use
+		running status unless it's turned off here.
+
+		@param running: leave out repeated status bytes
+		@param noteoff_as_noteon: send NoteOffs as NoteOns with
+			velocity 0, to make longer runs
+		"""
+		self.encoders[output] = MidiRunningStatusEncoder(running,
+			noteoff_as_noteon)
 
 	def _insert_in_schedule(self,msg):
-		# Insert into scheduled list, can be optimized
-		inserted = False
-		ix = 0
 		self.scheduled_lock.acquire()
-		for i in self.scheduled:
-			if msg.time < i.time:
-				inserted = True
-				self.scheduled.insert(ix,msg)
-				break
-			ix = ix + 1
-		if not inserted:
-			self.scheduled.append(msg)
+		self.scheduled.push(msg)
+		self.next_scheduled = self.scheduled.next_time()
+		self.scheduled_lock.release()
+		self._wake(msg.time)
+
+	def _poll_sources(self):
+		# Called at the top of each loop, to bring in anything
+		# scheduled from elsewhere.
+		if self.submitted:
+			self._drain_submitted()
+		if self.wire_changes:
+			self._change_wires()
+
+	def _submit(self,msgs):
+		# msgs must be in time order
+		if len(msgs) == 0:
+			return
+		self.submitted.append(msgs)
+		self._wake(msgs[0].time)
 
-		self.next_scheduled = self.scheduled[0].time
+	def _drain_submitted(self):
+		batches = []
+		try:
+			while True:
+				batches.append(self.submitted.popleft())
+		except IndexError:
+			pass
+		if len(batches) == 0:
+			return
+		self.scheduled_lock.acquire()
+		for b in batches:
+			self.scheduled.push_many(b)
+		self.next_scheduled = self.scheduled.next_time()
 		self.scheduled_lock.release()
 
+	def _insert_many_in_schedule(self,msgs):
+		if len(msgs) == 0:
+			return
+		self.scheduled_lock.acquire()
+		self.scheduled.push_many(msgs)
+		self.next_scheduled = self.scheduled.next_time()
+		self.scheduled_lock.release()
+		self._wake(min([m.time for m in msgs]))
+
 	def printschedule(self,label=""):
 		self.scheduled_lock.acquire()
 		if len(self.scheduled) == 0:
@@ -827,8 +2342,9 @@ class MidiThread(Thread):
 			self.scheduled_lock.release()
 			return
 		print "=== Schedule list %s ===" % label
-		for i in self.scheduled:
-			print "i=",i
+		for i in self.scheduled.items():
+			if not i.cancelled:
+				print "i=",i
 		print "next_scheduled=",self.next_scheduled
 		print "========="
 		self.scheduled_lock.release()
@@ -844,12 +2360,76 @@ class MidiThread(Thread):
 		else:
 			tm0 = time
 
+		sched = self._expand(output,msg,tm0)
+		if self.submit == "queue":
+			self._submit(sched)
+		elif len(sched) == 1:
+			self._insert_in_schedule(sched[0])
+		else:
+			self._insert_many_in_schedule(sched)
+		return ScheduleHandle(self,sched)
+
+	def schedule_realtime(self,output,msg,time=None):
+		"""
+		Schedule msg (normally a RealTime, e.g. a clock pulse) in the
+		high-priority lane.  That's dispatched before the rest of the
+		schedule, and without the lookahead, so the message goes out
+		before other messages due at the same time.
+		"""
+		if not output.is_open():
+			raise Exception, "schedule_realtime(): output device isn't open?"
+		if time == None:
+			time = self.timenow
+		s = ScheduledMidiMsg(time,msg,output=output)
+		self._insert_realtime(s)
+		return ScheduleHandle(self,[s])
+
+	def _insert_realtime(self,s):
+		self.scheduled_lock.acquire()
+		self.realtime_lane.push(s)
+		self.next_realtime = self.realtime_lane.next_time()
+		self.scheduled_lock.release()
+		self._wake(s.time + self.lookahead)
+
+	def schedule_many(self,output,msgs,time=None):
+		"""
+		Schedule a sequence of messages with a single acquisition
+		of the schedule lock.
+
+		@param msgs: a sequence of MidiMsgs, SequencedEvents (e.g. a
+			Phrase) and/or (time,msg) tuples.  MidiMsgs are scheduled
+			at time, SequencedEvents at time plus their clocks, and
+			tuples at their own time.
+		@param time: the base time, or None for now
+		"""
+		if not output.is_open():
+			raise Exception, "schedule_many(): output device isn't open?"
+		if time == None:
+			tm0 = self.timenow
+		else:
+			tm0 = time
+
+		sched = []
+		for msg in msgs:
+			if isinstance(msg,tuple):
+				sched.extend(self._expand(output,msg[1],msg[0]))
+			else:
+				sched.extend(self._expand(output,msg,tm0))
+		# sort is stable, so equal times keep their order
+		sched.sort(key=lambda m: m.time)
+		if self.submit == "queue":
+			self._submit(sched)
+		else:
+			self._insert_many_in_schedule(sched)
+		return ScheduleHandle(self,sched)
+
+	def _expand(self,output,msg,tm0):
+		# Returns the list of ScheduledMidiMsgs for msg
+
 		# Non-sequenced MidiMsg have no clocks value
 		if isinstance(msg,MidiMsg):
 			# print "Scheduling non-seq tm0=",tm0
-			m = ScheduledMidiMsg(tm0,msg,output=output)
-			self._insert_in_schedule(m)
-			return
+			return [ScheduledMidiMsg(tm0,msg,output=output)]
 
 		if not isinstance(msg,SequencedEvent):
 			raise Exception,"schedule needs a SequencedMidiMsg or MidiMsg"
@@ -857,9 +2437,8 @@ class MidiThread(Thread):
 		tm1 = tm0 + self.clocks2secs(msg.clocks)
 
 		if isinstance(msg,SequencedMidiMsg):
-			n1 = ScheduledMidiMsg(tm1,msg.msg,output=output)
 			# print "Scheduling seq tm1=",tm1
-			self._insert_in_schedule(n1)
+			return [ScheduledMidiMsg(tm1,msg.msg,output=output)]
 
 		elif isinstance(msg,SequencedNote):
 			tm2 = tm0 + self.clocks2secs(msg.clocks+msg.duration)
@@ -879,150 +2458,272 @@ class MidiThread(Thread):
 					),
 				output = output
 				)
-			self._insert_in_schedule(n1)
-			self._insert_in_schedule(n2)
+			n2.noteon = n1
+			return [n1,n2]
 		else:
 			raise Exception,"schedule isn't prepared to handle msg=",msg
 
 	def _gotmidi(self,device,bytes,tm):
+		self._decode_midi(device,bytes,device.event_time(tm,self.clock))
+
+	def _decode_midi(self,device,bytes,secs):
 		b0 = bytes[0]
-		b1 = bytes[1]
-		b2 = bytes[2]
-		b3 = bytes[3]
-		secs = tm / 1000.0
+
+		if device.sysex is _discarded_sysex:
+			if b0 < 0x80 or b0 == EOX:
+				# Still in a discarded sysex
+				if EOX in bytes:
+					device.sysex = None
+				return
+			if b0 < 0xf8:
+				device.sysex = None
+
+		f = device.filter
+		if f != None:
+			if f.discard[b0]:
+				f.counts[b0] += 1
+				if b0 < 0xf8 and device.sysex != None:
+					# The status byte still ends a sysex
+					self._end_sysex(device,device.sysex,secs)
+				if b0 == 0xf0 and not EOX in bytes:
+					device.sysex = _discarded_sysex
+				return
 
 		if Midi.debug:
-			print "b0123=",b0, b1, b2, b3, " tm=",tm," time=",time.time()
+			print "b0123=",b0, bytes[1], bytes[2], bytes[3], " secs=",secs," time=",time.time()
 
 		# Realtime messages can occur anytime
-		if (b0 & 0xf8) == 0xf8:
+		if b0 >= 0xf8:
 			# could be 0xf8, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe or 0xff
-			m = RealTime(b0)
-			m.device = device
-			self._push_input_msg(m,secs)
+			self._push_input_short(device,b0,0,0,secs)
 			return
 
-		finished = True
-
-		# If we're in the process of receiving a sysex...
+		# If we're in the process of receiving a sysex,
+		# any non-realtime status byte other than EOX ends it.
 		m = device.sysex
 		if m != None:
-			# ... and we receive a non-realtime status byte
-			# or an EOX, we finish the sysex off
-			if (b0 & 0x80) == 0x80 and b0 != EOX:
-				# non-realtime status bytes always terminate it
+			if b0 >= 0x80 and b0 != EOX:
 				if Midi.debug:
 					print "PUSHING SYSEX ended by status "
-				self._push_input_msg(m,secs)
-				device.sysex = None
-				# Set m to None in order to make sure that
-				# we continue on and process the status msg
-				m = None
+				self._end_sysex(device,m,secs)
 			else:
-				# Otherwise append bytes to the sysex until EOX
-				m.append(b0)
-				if b0 != EOX:
-				  m.append(b1)
-				  if b1 != EOX:
-				    m.append(b2)
-				    if b2 != EOX:
-				      m.append(b3)
-				      if b3 != EOX:
-					# If no EOX, then we don't want to
-					# finish off the sysex
-				        finished = False
-				if finished:
-					device.sysex = None
-
-			if m != None:
-				# Keep the time when the sysex was created
-				if finished:
-					self._push_input_msg(m,secs)
+				self._decode_sysex(device,m,bytes,0,secs)
 				return
 
-		if (b0 & 0xf0) == 0x80:
-			m = NoteOff(channel=(b0&0x0f)+1,pitch=b1,velocity=b2)
-		elif (b0 & 0xf0) == 0x90:
-			if b2 == 0:
-				m = NoteOff(channel=(b0&0x0f)+1,pitch=b1,velocity=b2)
+		if b0 >= 0xf0:
+			if self.sysex_chunk:
+				m = SysExChunk(b0)
 			else:
-				m = NoteOn(channel=(b0&0x0f)+1,pitch=b1,velocity=b2)
-		elif (b0 & 0xf0) == 0xa0:
-			m = Pressure(channel=(b0&0x0f)+1,pitch=b1,pressure=b2)
-		elif (b0 & 0xf0) == 0xb0:
-			m = Controller(channel=(b0&0x0f)+1,controller=b1,value=b2)
-		elif (b0 & 0xf0) == 0xc0:
-			m = Program(channel=(b0&0x0f)+1,program=b1)
-		elif (b0 & 0xf0) == 0xd0:
-			m = ChannelPressure(channel=(b0&0x0f)+1,pressure=b1)
-		elif (b0 & 0xf0) == 0xe0:
-			m = PitchBend(channel=(b0&0x0f)+1,value=(b1&0x3f)+((b2&0x3f)<<6))
-		elif (b0 & 0xf0) == 0xf0:
-			m = SysEx(b0)
+				m = SysEx(b0)
+			m.device = device
 			device.sysex = m
-			m.append(b1)
-			if b1 != EOX:
-			  m.append(b2)
-			  if b2 != EOX:
-			    m.append(b3)
-			    if b3 != EOX:
-			      # If no EOX, then we don't want to
-			      # finish off the sysex
-			      finished = False
-			if finished:
-				device.sysex = None
-
-		if m == None:
-			print "Unexpected, m==None?  b0=",b0
+			self._decode_sysex(device,m,bytes,1,secs)
+		elif input_status_table[b0] != None:
+			self._push_input_short(device,b0,bytes[1],bytes[2],secs)
 		else:
-			m.device = device
-			if finished:
+			print "Unexpected, m==None?  b0=",b0
+
+	def _decode_sysex(self,device,m,bytes,i,secs):
+		# Append bytes[i:] to the sysex m until EOX, and push it
+		# if it's finished.
+		data = bytes[i:4]
+		if EOX in data:
+			m.extend(data[:data.index(EOX)+1])
+			self._end_sysex(device,m,secs)
+			return
+		m.extend(data)
+		n = len(m.bytes)
+		if self.sysex_chunk:
+			if n >= self.sysex_chunk:
+				# Pass this much on, and carry on in a new chunk
+				c = SysExChunk(offset=m.offset+n)
+				c.device = device
+				device.sysex = c
 				self._push_input_msg(m,secs)
+		elif n > self.sysex_max:
+			# Skip the rest of it
+			device.sysex = _discarded_sysex
+			self._input_counters_for(device)["dropped"] += 1
+
+	def _end_sysex(self,device,m,secs):
+		device.sysex = None
+		if isinstance(m,SysExChunk):
+			m.last = True
+		self._push_input_msg(m,secs)
+
+	def _push_input_short(self,device,b0,b1,b2,secs):
+		if self.rawcallback_func:
+			try:
+				self.rawcallback_func((secs,device,b0,b1,b2),
+					self.rawcallback_data)
+			except:
+				print "Exception in midi raw callback: "+format_exc()
+			if not self._wants_events():
+				self._input_counters_for(device)["received"] += 1
+				return
+		self._push_input_event(RawMidiEvent(device,b0,b1,b2,secs),device)
+
+	def _wants_events(self):
+		# Whether anything needs MidiEvents for input
+		return (self.callback_func != None or len(self.router) > 0
+			or self.batchcallback_func != None)
 
 	def _push_input_msg(self,midimsg,tm):
+		self._push_input_event(MidiEvent(midimsg,tm),
+			getattr(midimsg,"device",None))
+
+	def _push_input_event(self,e,device):
+		self._input_counters_for(device)["received"] += 1
+		if self.batchcallback_func:
+			self.input_batched.append(e)
+			if self.callback_func == None and len(self.router) == 0:
+				return
+		self._deliver_input(e)
 
-		e = MidiEvent(midimsg,tm)
+	def _flush_input_batch(self):
+		# Deliver the events batched in this pass, as one list
+		batch = self.input_batched
+		self.input_batched = []
+		if not self.batchcallback_func:
+			return
+		# Each input's events are in order already, this merges them
+		batch.sort(key=lambda e: e.time)
+		self._deliver_input(batch)
+
+	def _deliver_input(self,e):
+		# e is a MidiEvent, or a list of them for the batch callback
+		delivery = self.input_delivery
+		if delivery == "direct":
+			self._invoke_callback(e)
+		elif delivery == "thread":
+			w = self.callback_worker
+			if w == None:
+				w = self._start_callback_worker()
+			if not w.put(e):
+				self._count_dropped(e)
+		else:
+			self.executor_lock.acquire()
+			if self.executor_pending >= self.input_queue_size:
+				self.executor_lock.release()
+				self._count_dropped(e)
+				return
+			self.executor_pending += 1
+			self.executor_lock.release()
+			delivery.submit(self._executor_callback,e)
+
+	def _count_dropped(self,e):
+		if isinstance(e,list):
+			for be in e:
+				self._count_dropped(be)
+			return
+		device = getattr(e,"device",None)
+		if device == None:
+			device = getattr(e.midimsg,"device",None)
+		self._input_counters_for(device)["dropped"] += 1
+
+	def _invoke_callback(self,e):
+		if isinstance(e,list):
+			try:
+				self.batchcallback_func(e,self.batchcallback_data)
+			except:
+				print "Exception in midi batch callback: "+format_exc()
+			return
 		if self.callback_func:
 			try:
 				self.callback_func(e,self.callback_data)
 			except:
 				print "Exception in midi callback: "+format_exc()
+		if len(self.router) > 0:
+			self.router.dispatch(e)
 
-	def _insert_timer(self, timerEvent):
-		# Insert into scheduled list, can be optimized
-		inserted = False
-		ix = 0
-		for i in self._timer_calls:
-			if timerEvent.time < i.time:
-				inserted = True
-				self._timer_calls.insert(ix, timerEvent)
-				break
-			ix = ix + 1
-		if not inserted:
-			self._timer_calls.append(timerEvent)
+	def _executor_callback(self,e):
+		try:
+			self._invoke_callback(e)
+		finally:
+			self.executor_lock.acquire()
+			self.executor_pending -= 1
+			self.executor_lock.release()
+
+	def _start_callback_worker(self):
+		w = MidiCallbackWorker(self,self.input_queue_size)
+		self.callback_worker = w
+		w.start()
+		return w
+
+	def _stop_callback_worker(self):
+		w = self.callback_worker
+		if w:
+			self.callback_worker = None
+			w.stop()
+			w.join()
+
+	def _input_counters_for(self,device):
+		c = self.input_counters.get(device)
+		if c == None:
+			c = self.input_counters.setdefault(device,
+				{"received":0, "dropped":0})
+		return c
+
+	def get_input_counters(self):
+		"""
+		Returns a dictionary, keyed by input name, of the number of
+		events received from each input, the number dropped because
+		the input queue was full, and for inputs with a filter, the
+		number filtered out.
+		"""
+		counters = {}
+		for (device,c) in self.input_counters.items():
+			counters[getattr(device,"name",None)] = dict(c)
+		for device in self.midiin.keys():
+			f = getattr(device,"filter",None)
+			if f != None:
+				c = counters.setdefault(device.name,
+					{"received":0, "dropped":0})
+				c["filtered"] = f.nfiltered()
+		return counters
+
+	def reset_input_counters(self):
+		self.input_counters = {}
 
-		self._next_timer = self._timer_calls[0].time
+	def _insert_timer(self, timerEvent):
+		self.timer_lock.acquire()
+		heapq.heappush(self._timer_calls,
+			(timerEvent.time, self._timer_seq.next(), timerEvent))
+		self._next_timer = self._timer_calls[0][0]
+		self.timer_lock.release()
 
 	def _invoke_timer_callbacks(self, now):
 		if self._next_timer is None:
 			return
 		to_reschedule = []
-		while self._next_timer <= now:
-			s = self._timer_calls.pop(0)
+		while True:
+			self.timer_lock.acquire()
+			if not self._timer_calls or self._timer_calls[0][0] > now:
+				self.timer_lock.release()
+				break
+			s = heapq.heappop(self._timer_calls)[2]
+			self.timer_lock.release()
+			# Cancelled timers are skipped when they come due
+			if s.cancelled:
+				continue
 			try:
 				nextTime = s.invoke(now)
-				if nextTime:
+				if nextTime and not s.cancelled:
 					to_reschedule.append(s)
 			except:
 				print "Error invoking scheduled callback: %s" % format_exc()
-			# break out of the loop if no more calls for now (or at all)
-			if not self._timer_calls:
-				break
-			else:
-				self._next_timer = self._timer_calls[0].time
-		[self._insert_timer(s) for s in to_reschedule]
-		self._next_timer = self._timer_calls and self._timer_calls[0].time or None
-			
+		# Rescheduled timers go back in after the loop, so that
+		# they aren't invoked again for this same time.
+		self.timer_lock.acquire()
+		for s in to_reschedule:
+			heapq.heappush(self._timer_calls,
+				(s.time, self._timer_seq.next(), s))
+		if self._timer_calls:
+			self._next_timer = self._timer_calls[0][0]
+		else:
+			self._next_timer = None
+		self.timer_lock.release()
+
 	def schedule_callback(self, func, time=None, *args, **kwargs):
 		"""
 		Schedule a function to be invoked during the main MIDI processing
@@ -1047,20 +2748,188 @@ class MidiThread(Thread):
 			the function for immediate invocation
 		@param *args: additional arguments to pass to the function
 		@param **kwargs: additional keyword arguments to pass to the function
+		@return: the TimerEvent, whose cancel() method removes the
+			callback from the schedule
+
+		This can be called from any thread.  Callbacks due at the same
+		time are invoked in the order they were scheduled.
 		"""
-		if not time:
-			time = Midi.time_now()
+		if time is None:
+			time = self.clock.time_now()
 		timerEvent = TimerEvent(time, func, *args, **kwargs)
 		self._insert_timer(timerEvent)
+		self._wake(time)
+		return timerEvent
+
+class LatenessHistogram:
+	"""
+	Counts of dispatch lateness (send time minus scheduled time)
+	in fixed buckets of resolution seconds, up to maxsecs.  Early
+	sends go in the first bucket, and anything beyond maxsecs in
+	the last one.
+	"""
+
+	def __init__(self,resolution=0.0001,maxsecs=0.1):
+		self.resolution = resolution
+		self.nbuckets = int(round(maxsecs / resolution)) + 1
+		self.reset()
+
+	def reset(self):
+		self.buckets = [0] * self.nbuckets
+		self.count = 0
+		self.total = 0.0
+		self.max = None
+
+	def record(self,late):
+		i = int(late / self.resolution)
+		if i < 0:
+			i = 0
+		elif i >= self.nbuckets:
+			i = self.nbuckets - 1
+		self.buckets[i] += 1
+		self.count += 1
+		self.total += late
+		if self.max == None or late > self.max:
+			self.max = late
+
+	def percentile(self,pct):
+		# Returns the upper edge of the bucket holding the percentile
+		if self.count == 0:
+			return None
+		want = self.count * pct / 100.0
+		n = 0
+		for i in range(self.nbuckets):
+			n += self.buckets[i]
+			if n >= want:
+				return (i + 1) * self.resolution
+		return self.nbuckets * self.resolution
+
+	def summary(self):
+		if self.count == 0:
+			return {"count":0}
+		return {
+			"count": self.count,
+			"mean": self.total / self.count,
+			"p50": self.percentile(50),
+			"p90": self.percentile(90),
+			"p99": self.percentile(99),
+			"max": self.max,
+			}
+
+class MidiOutputWorker(Thread):
+	"""
+	Writes the scheduled messages for a single output, in the order
+	they're given to it, on its own thread.
+	"""
+
+	def __init__(self,midithread,output):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.midithread = midithread
+		self.output = output
+		self.pending = deque()
+		self.cond = threading.Condition()
+		self.keepgoing = True
+
+	def put(self,s,now):
+		self.cond.acquire()
+		self.pending.append((s,now))
+		self.cond.notify()
+		self.cond.release()
+
+	def stop(self):
+		# Anything already queued is still written
+		self.cond.acquire()
+		self.keepgoing = False
+		self.cond.notify()
+		self.cond.release()
+
+	def run(self):
+		while True:
+			self.cond.acquire()
+			while len(self.pending) == 0 and self.keepgoing:
+				self.cond.wait()
+			if len(self.pending) == 0:
+				self.cond.release()
+				return
+			todo = list(self.pending)
+			self.pending.clear()
+			self.cond.release()
+			for (s,now) in todo:
+				self.midithread._write_scheduled(s,now)
+
+# device.sysex while the rest of a filtered-out sysex is skipped
+_discarded_sysex = SysEx()
+
+class MidiCallbackWorker(Thread):
+	"""
+	Calls the input callback, on its own thread, for the events
+	queued with put().
+	"""
+
+	def __init__(self,midithread,maxlen):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.midithread = midithread
+		self.maxlen = maxlen
+		self.pending = deque()
+		self.cond = threading.Condition()
+		self.keepgoing = True
+
+	def put(self,e):
+		# Returns False if the queue is full
+		self.cond.acquire()
+		if len(self.pending) >= self.maxlen:
+			self.cond.release()
+			return False
+		self.pending.append(e)
+		self.cond.notify()
+		self.cond.release()
+		return True
+
+	def stop(self):
+		# Anything already queued is still delivered
+		self.cond.acquire()
+		self.keepgoing = False
+		self.cond.notify()
+		self.cond.release()
+
+	def run(self):
+		while True:
+			self.cond.acquire()
+			while len(self.pending) == 0 and self.keepgoing:
+				self.cond.wait()
+			if len(self.pending) == 0:
+				self.cond.release()
+				return
+			e = self.pending.popleft()
+			self.cond.release()
+			self.midithread._invoke_callback(e)
 
 class MidiBaseHardwareInput:
 
+	# A MidiInputFilter, or None to pass everything
+	filter = None
+
 	def __init__(self,input_name):
 		raise Exception,"MidiBaseHardwareInput, no input matches: %s" % input_name
 
 	def device_index(self):
 		return 1;
 
+	def event_time(self,tm,clock):
+		# Convert the device's timestamp for an input event to clock
+		# time.  By default, there's no device clock.
+		return clock.time_now()
+
+	def set_filter(self,f):
+		"""
+		Discard the input messages that MidiInputFilter f says to,
+		or none if f is None.
+		"""
+		self.filter = f
+		self.sysex = None
+
 	def open(self):
 		raise Exception, "MidiBaseHardwareInput, unable to open "+self.name
 
@@ -1091,7 +2960,10 @@ class MidiBaseHardwareOutput:
 		pass
 
 	def schedule(self,msg,time=None):
-		Midi.schedule(self,msg,time)
+		return Midi.schedule(self,msg,time)
+
+	def schedule_many(self,msgs,time=None):
+		return Midi.schedule_many(self,msgs,time)
 
 
 	def __str__(self):